@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+
+import os, sys, time, json, socket, argparse, subprocess
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+import numpy as np
+from common.simulator import input_init, lstm_model_path, bpw_model_path, k2rz_model_path, bpw_ymean, bpw_ystd
+
+# Benchmark suite for model inference, GUI start-up and redraw, runnable headless.
+# Every run is appended to a JSON-lines history file and compared with the previous run.
+
+base_path = os.path.abspath(os.path.dirname(sys.argv[0]))
+history_path = base_path + '/benchmark_history.jsonl'
+ensemble_sizes = [1, 2, 5, 10]
+batch_sizes = [1, 16, 256]
+
+def measure(f, repeat=20, warmup=2):
+    for i in range(warmup):
+        f()
+    ts = []
+    for i in range(repeat):
+        t = time.perf_counter()
+        f()
+        ts.append(time.perf_counter() - t)
+    return {'median_ms': 1.e3 * np.median(ts), 'mean_ms': 1.e3 * np.mean(ts), 'min_ms': 1.e3 * np.min(ts), 'repeat': repeat}
+
+def load_models(backend, n_models):
+    if backend == 'keras':
+        from common.model_structure import k2rz, kstar_v220505, tf_dense_model
+        return (k2rz(k2rz_model_path, n_models=n_models),
+                kstar_v220505(lstm_model_path, n_models=n_models, fused=True),
+                tf_dense_model(bpw_model_path, n_models=n_models, ymean=bpw_ymean, ystd=bpw_ystd, fused=True))
+    from common.numpy_models import np_k2rz, np_kstar_v220505, np_tf_dense_model
+    return (np_k2rz(k2rz_model_path, n_models=n_models),
+            np_kstar_v220505(lstm_model_path, n_models=n_models),
+            np_tf_dense_model(bpw_model_path, n_models=n_models, ymean=bpw_ymean, ystd=bpw_ystd))
+
+def bench_models(backends, sizes=ensemble_sizes, batches=batch_sizes, repeat=20):
+    rng = np.random.default_rng(0)
+    u = np.array(input_init)
+    k2rz_x = [u[0], u[1], 1.0, u[10], u[11], u[12], u[13], u[14]]
+    results = {}
+    for backend in backends:
+        k2rz, lstm, bpw = load_models(backend, max(sizes))
+        k2rz.set_inputs(*k2rz_x)
+        for n in sizes:
+            k2rz.nmodels = lstm.nmodels = bpw.nmodels = n
+            results[f'k2rz.predict/{backend}/m{n}'] = measure(lambda: k2rz.predict(post=True), repeat)
+            for b in batches:
+                x = rng.normal(size=(b, lstm.length, 18))
+                results[f'kstar_v220505.predict/{backend}/m{n}/b{b}'] = measure(lambda: lstm.predict_ensemble(x), repeat)
+                x = rng.normal(size=(b, 8))
+                results[f'tf_dense_model.predict/{backend}/m{n}/b{b}'] = measure(lambda: bpw.predict_ensemble(x), repeat)
+    table = os.path.join(base_path, 'weights', 'k2rz_table_v1.npz')
+    if os.path.exists(table):
+        from common.boundary_table import table_k2rz
+        k2rz = table_k2rz(table)
+        k2rz.set_inputs(*k2rz_x)
+        results['k2rz.predict/table'] = measure(lambda: k2rz.predict(post=True), repeat)
+    return results
+
+def bench_gui(backends, sizes=ensemble_sizes, repeat=20):
+    # KSTARWidget start-up and the per-update redraw, synchronously on the offscreen platform
+    from PyQt5.QtWidgets import QApplication
+    app = QApplication.instance() or QApplication([])
+    import kstar_simulator_v1 as gui
+
+    results = {}
+    for backend in backends:
+        gui.backend = backend
+        t = time.perf_counter()
+        window = gui.KSTARWidget()
+        results[f'KSTARWidget.__init__/{backend}'] = {'median_ms': 1.e3 * (time.perf_counter() - t), 'repeat': 1}
+        window.show()
+        app.processEvents()
+
+        def redraw():
+            window.worker.publish(window.simulate(window.getActuators()))
+            window.showResult()
+            window.canvas.flush_events()
+            app.processEvents()
+
+        def replot():
+            window.rePlotOutputBox()
+            window.canvas.draw()
+            app.processEvents()
+
+        for n in sizes:
+            window.nModelBox.setValue(n)
+            window.worker.submit(lambda: None)
+            while window.worker.jobs:
+                time.sleep(1.e-3)
+            results[f'reCreateOutputBox/{backend}/m{n}'] = measure(redraw, repeat)
+        results[f'rePlotOutputBox/{backend}'] = measure(replot, repeat)
+        window.worker.stop()
+        window.close()
+    return results
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=base_path, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, history):
+    # Median ratio against the latest previous run that measured the same benchmark
+    previous = {}
+    for entry in history:
+        previous.update(entry['results'])
+    for name, result in results.items():
+        ratio = f"{result['median_ms'] / previous[name]['median_ms']:6.2f}x" if name in previous else '    new'
+        print(f"{name:50s} {result['median_ms']:10.3f} ms  {ratio}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='KSTAR-NN benchmark suite')
+    parser.add_argument('--suites', nargs='+', default=['models', 'gui'], choices=['models', 'gui'])
+    parser.add_argument('--backends', nargs='+', default=['keras', 'numpy'], choices=['keras', 'numpy'])
+    parser.add_argument('--ensemble-sizes', type=int, nargs='+', default=ensemble_sizes)
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=batch_sizes)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--history', default=history_path)
+    parser.add_argument('--no-save', action='store_true')
+    args = parser.parse_args()
+
+    results = {}
+    if 'models' in args.suites:
+        results.update(bench_models(args.backends, args.ensemble_sizes, args.batch_sizes, args.repeat))
+    if 'gui' in args.suites:
+        results.update(bench_gui(args.backends, args.ensemble_sizes, args.repeat))
+
+    history = []
+    if os.path.exists(args.history):
+        with open(args.history) as f:
+            history = [json.loads(line) for line in f if line.strip()]
+    compare(results, history)
+    if not args.no_save:
+        entry = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'host': socket.gethostname(), 'revision': git_revision(), 'results': results}
+        with open(args.history, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+        print(f'Results appended to {args.history}')
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+
+import sys, argparse
+import numpy as np
+from common.simulator import KSTARSimulator, input_params, input_mins, input_maxs, nn_features, bpw_features,\
+                             lstm_model_path, nn_model_path, bpw_model_path, k2rz_model_path, bpw_ymean, bpw_ystd
+
+# Regression check of the pure-NumPy engines against the Keras models on the shipped weights.
+# Errors are the largest deviation from Keras relative to the spread of the Keras outputs;
+# the script exits non-zero when any check exceeds the tolerance.
+
+tolerance = 1.e-4
+
+def compare(name, keras_y, numpy_y, tolerance=tolerance):
+    keras_y, numpy_y = np.asarray(keras_y, dtype=float), np.asarray(numpy_y, dtype=float)
+    if keras_y.shape != numpy_y.shape:
+        print(f'{name:50s} shape {numpy_y.shape} != {keras_y.shape}  FAIL')
+        return False
+    error = np.max(np.abs(numpy_y - keras_y)) / max(np.std(keras_y), 1.e-12)
+    print(f"{name:50s} max error / std {error:.2e}  {'ok' if error <= tolerance else 'FAIL'}")
+    return error <= tolerance
+
+def check_lstm(n_models, batch, rng, tolerance=tolerance):
+    from common.model_structure import kstar_v220505
+    from common.numpy_models import np_kstar_v220505
+    keras, engine = kstar_v220505(lstm_model_path, n_models=n_models), np_kstar_v220505(lstm_model_path, n_models=n_models)
+    x = rng.normal(size=(batch, keras.length, 18))
+    xs = rng.normal(size=(n_models, batch, keras.length, 18))
+    return [compare('kstar_v220505.predict_ensemble', keras.predict_ensemble(x), engine.predict_ensemble(x), tolerance),
+            compare('kstar_v220505.predict_ensemble per member', keras.predict_ensemble(xs, per_member=True),
+                    engine.predict_ensemble(xs, per_member=True), tolerance),
+            compare('kstar_v220505.predict', keras.predict(x[:1]), engine.predict(x[:1]), tolerance)]
+
+def random_actuators(rng, n):
+    return rng.uniform(input_mins, input_maxs, (n, len(input_params)))
+
+def check_dense(n_models, batch, rng, tolerance=tolerance):
+    from common.model_structure import k2rz, kstar_nn, tf_dense_model
+    from common.numpy_models import np_k2rz, np_kstar_nn, np_tf_dense_model
+    u = random_actuators(rng, batch)
+    results = []
+
+    x = nn_features(u)
+    keras, engine = kstar_nn(nn_model_path, n_models=n_models), np_kstar_nn(nn_model_path, n_models=n_models)
+    results.append(compare('kstar_nn.predict_ensemble', keras.predict_ensemble(x), engine.predict_ensemble(x), tolerance))
+
+    x = bpw_features(u, rng.uniform(0.5, 3., batch))
+    keras = tf_dense_model(bpw_model_path, n_models=n_models, ymean=bpw_ymean, ystd=bpw_ystd)
+    engine = np_tf_dense_model(bpw_model_path, n_models=n_models, ymean=bpw_ymean, ystd=bpw_ystd)
+    results.append(compare('tf_dense_model.predict_ensemble (bpw)', keras.predict_ensemble(x), engine.predict_ensemble(x), tolerance))
+
+    x = np.column_stack([u[:, 0], u[:, 1], rng.uniform(0.5, 2., batch), u[:, 10:15]])
+    keras, engine = k2rz(k2rz_model_path, n_models=n_models), np_k2rz(k2rz_model_path, n_models=n_models)
+    results.append(compare('k2rz.predict_batch', keras.predict_batch(x), engine.predict_batch(x), tolerance))
+    keras.set_inputs(*x[0])
+    engine.set_inputs(*x[0])
+    results.append(compare('k2rz.predict_members', keras.predict_members(), engine.predict_members(), tolerance))
+    return results
+
+def check_simulator(n_models, batch, rng, tolerance=tolerance, steps=20):
+    # Whole rollouts: LSTM window updates, feature assembly and boundaries of both backends
+    u = random_actuators(rng, 2)
+    waveforms = np.concatenate([np.tile(u[0], (steps // 2, 1)), u[0] + np.linspace(0, 1, steps - steps // 2)[:, None] * (u[1] - u[0])])
+    keras, engine = [KSTARSimulator(n_models=n_models, max_models=n_models, n_shape_models=n_models, backend=backend) for backend in ['keras', 'numpy']]
+    (ys0, rbdry0, zbdry0), (ys1, rbdry1, zbdry1) = keras.rollout(waveforms, boundary=True), engine.rollout(waveforms, boundary=True)
+    return [compare('KSTARSimulator.rollout outputs', ys0, ys1, tolerance),
+            compare('KSTARSimulator.rollout boundaries', np.stack([rbdry0, zbdry0]), np.stack([rbdry1, zbdry1]), tolerance)]
+
+checks = {'lstm': check_lstm, 'dense': check_dense, 'simulator': check_simulator}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the NumPy engines with the Keras models')
+    parser.add_argument('--checks', nargs='+', default=list(checks.keys()), choices=list(checks.keys()))
+    parser.add_argument('--n-models', type=int, default=10)
+    parser.add_argument('--batch', type=int, default=16)
+    parser.add_argument('--tolerance', type=float, default=tolerance)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    results = [ok for name in args.checks for ok in checks[name](args.n_models, args.batch, rng, args.tolerance)]
+    print(f'{sum(results)}/{len(results)} checks passed')
+    sys.exit(0 if all(results) else 1)
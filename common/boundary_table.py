@@ -0,0 +1,140 @@
+import argparse, itertools
+import numpy as np
+from common.numpy_models import np_dense_model, load_dense_weights, k2rz_post, k2rz_post_members, k2rz_post_batch
+from common.simulator import base_path, k2rz_model_path, input_mins, input_maxs
+
+# Precomputed k2rz boundaries for the fast (kHz) boundary mode.
+# The ensemble-mean network output (ntheta R values then ntheta Z values, before the X-point
+# correction) is sampled on a regular grid over the 8 k2rz inputs, compressed onto its leading
+# principal components and reconstructed at run time by multilinear interpolation of the
+# component coefficients. The X-point correction is applied afterwards as in k2rz.
+
+table_version = 1
+table_path = base_path + f'/weights/k2rz_table_v{table_version}.npz'
+
+# k2rz inputs: ip, bt, βp, rin, rout, k, du, dl; βp is a model output and gets its own range
+table_inputs = ['ip', 'bt', 'betap', 'rin', 'rout', 'k', 'du', 'dl']
+input_index = [0, 1, None, 10, 11, 12, 13, 14]
+betap_range = [0.2, 2.5]
+table_mins = np.array([input_mins[i] if i is not None else betap_range[0] for i in input_index])
+table_maxs = np.array([input_maxs[i] if i is not None else betap_range[1] for i in input_index])
+
+def sample_network(model, x, n_models, chunk_size=16384):
+    # Ensemble-mean k2rz output for (P, 8) inputs, evaluated chunk by chunk
+    return np.concatenate([np.mean(model.predict(x[i:i + chunk_size], n_models), axis=0, dtype=float)
+                           for i in range(0, len(x), chunk_size)])
+
+def grid_points(axes, start, stop):
+    return np.array(list(itertools.product(*axes[start:stop]))) if stop > start else np.zeros([1, 0])
+
+def build_table(model_path=k2rz_model_path, n_models=1, points_per_axis=5, n_components=16, n_test=4096,
+                output_path=table_path, chunk_size=16384, seed=0):
+    model = np_dense_model(*load_dense_weights(model_path, n_models))
+    npoints = np.broadcast_to(points_per_axis, (len(table_inputs),)).astype(int)
+    if np.any(npoints < 2):
+        # Multilinear interpolation needs a lower and an upper grid point on every axis
+        raise ValueError(f'Boundary table needs at least 2 points per axis, got {npoints.tolist()}')
+    axes = [np.linspace(lo, hi, n) for lo, hi, n in zip(table_mins, table_maxs, npoints)]
+    total = int(np.prod(npoints))
+
+    def chunks():
+        # Grid samples in C order, the trailing axes enumerated per chunk to bound memory
+        split = len(axes)
+        while split > 0 and np.prod(npoints[split - 1:]) <= chunk_size:
+            split -= 1
+        tail = grid_points(axes, split, len(axes))
+        for head in itertools.product(*axes[:split]):
+            x = np.concatenate([np.tile(head, (len(tail), 1)), tail], axis=1)
+            yield sample_network(model, x, n_models, chunk_size)
+
+    # Principal components from the accumulated mean and covariance
+    n_outputs = model.params[f'dense{len(model.activations) - 1}/bias'].shape[-1]
+    mean, second = np.zeros(n_outputs), np.zeros([n_outputs, n_outputs])
+    for y in chunks():
+        mean += np.sum(y, axis=0)
+        second += np.matmul(y.T, y)
+    mean /= total
+    eigenvalues, eigenvectors = np.linalg.eigh(second / total - np.outer(mean, mean))
+    basis = eigenvectors[:, ::-1][:, :n_components]
+
+    coefficients = np.concatenate([np.matmul(y - mean, basis) for y in chunks()])
+    table = {'version': np.array(table_version), 'inputs': np.array(table_inputs), 'n_models': np.array(n_models),
+             'mins': table_mins, 'maxs': table_maxs, 'npoints': npoints, 'mean': mean, 'basis': basis,
+             'coefficients': np.float32(coefficients.reshape(tuple(npoints) + (len(basis.T),)))}
+
+    # Error bound against the network on random inputs inside the box
+    x = np.random.default_rng(seed).uniform(table_mins, table_maxs, (n_test, len(table_inputs)))
+    error = np.abs(boundary_table(table).predict_raw(x) - sample_network(model, x, n_models, chunk_size))
+    table['error_max'], table['error_p99'], table['error_rms'] = np.max(error), np.percentile(error, 99), np.sqrt(np.mean(error**2))
+    np.savez(output_path, **table)
+    return output_path, {key: float(table[key]) for key in ['error_max', 'error_p99', 'error_rms']}
+
+class boundary_table():
+    def __init__(self, path=table_path):
+        data = np.load(path) if type(path) == str else path
+        if int(data['version']) != table_version:
+            raise ValueError(f"Boundary table {path} is version {int(data['version'])}, expected {table_version}; rebuild it")
+        self.mins, self.maxs, self.npoints = data['mins'], data['maxs'], data['npoints']
+        if np.any(self.npoints < 2):
+            raise ValueError(f'Boundary table {path} has fewer than 2 points on an axis; rebuild it')
+        self.mean, self.basis, self.coefficients = data['mean'], data['basis'], data['coefficients']
+        self.n_models = int(data['n_models'])
+        names = data.files if hasattr(data, 'files') else data.keys()
+        self.error = {key: float(data[key]) for key in ['error_max', 'error_p99', 'error_rms'] if key in names}
+        self.flat = self.coefficients.reshape(-1, self.coefficients.shape[-1])
+        self.strides = np.array([int(np.prod(self.npoints[i + 1:])) for i in range(len(self.npoints))])
+        self.corners = np.array(list(itertools.product([0, 1], repeat=len(self.npoints))))
+
+    def predict_raw(self, x):
+        # (8,) or (B, 8) k2rz inputs -> (2 * ntheta,) or (B, 2 * ntheta); inputs are clipped to the table box
+        x = np.asarray(x, dtype=float)
+        single = x.ndim == 1
+        x = np.atleast_2d(x)
+        position = (np.clip(x, self.mins, self.maxs) - self.mins) / (self.maxs - self.mins) * (self.npoints - 1)
+        lower = np.minimum(np.floor(position).astype(int), self.npoints - 2)
+        fraction = position - lower
+        index = np.matmul(lower, self.strides)[:, None] + np.matmul(self.corners, self.strides)
+        weight = np.prod(np.where(self.corners, fraction[:, None], 1 - fraction[:, None]), axis=-1)
+        y = self.mean + np.matmul(np.einsum('bc,bck->bk', weight, self.flat[index]), self.basis.T)
+        return y[0] if single else y
+
+class table_k2rz():
+    # Drop-in for k2rz/np_k2rz that reconstructs the boundary from a boundary_table
+    def __init__(self, path=table_path, ntheta=64, closed_surface=True, xpt_correction=True):
+        self.table = path if isinstance(path, boundary_table) else boundary_table(path)
+        self.nmodels, self.ntheta = self.table.n_models, ntheta
+        self.closed_surface, self.xpt_correction = closed_surface, xpt_correction
+
+    def set_inputs(self, ip, bt, βp, rin, rout, k, du, dl):
+        self.x = np.array([ip, bt, βp, rin, rout, k, du, dl])
+
+    def predict(self, post=True):
+        self.y = self.table.predict_raw(self.x)
+        rbdry, zbdry = self.y[:self.ntheta], self.y[self.ntheta:]
+        if post:
+            rbdry, zbdry = k2rz_post(self.x, rbdry, zbdry, self.closed_surface, self.xpt_correction)
+        return rbdry, zbdry
+
+    def predict_members(self, post=True):
+        # The table only holds the ensemble mean
+        self.ys = self.table.predict_raw(self.x)[None]
+        return k2rz_post_members(self.x, self.ys, self.ntheta, post, self.closed_surface, self.xpt_correction)
+
+    def predict_batch(self, xs, post=True):
+        return k2rz_post_batch(xs, self.table.predict_raw(xs), self.ntheta, post, self.closed_surface, self.xpt_correction)
+
+    def shuffle(self):
+        pass
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Tabulate the k2rz boundary ensemble for the fast boundary mode')
+    parser.add_argument('--n-models', type=int, default=1)
+    parser.add_argument('--points', type=int, nargs='+', default=[5], help='grid points per input, one value or 8')
+    parser.add_argument('--components', type=int, default=16)
+    parser.add_argument('--n-test', type=int, default=4096)
+    parser.add_argument('--output', default=table_path)
+    args = parser.parse_args()
+    path, error = build_table(n_models=args.n_models, points_per_axis=args.points if len(args.points) > 1 else args.points[0],
+                              n_components=args.components, n_test=args.n_test, output_path=args.output)
+    print(f'Boundary table written to {path}')
+    print(f"Error vs network [m]: max {error['error_max']:.4f}, p99 {error['error_p99']:.4f}, rms {error['error_rms']:.4f}")
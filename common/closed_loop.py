@@ -0,0 +1,91 @@
+import time, json, argparse
+import numpy as np
+from common.profiler import profiler
+from common.simulator import BatchKSTARSimulator, input_params, input_mins, input_maxs, input_init, output_params2
+from common.environment import default_targets
+
+# Closed-loop benchmark: an SB2 policy (or any object with predict(states)) drives a batch of
+# discharges toward target outputs. Reports control steps per second, per-stage latency and
+# tracking error, and writes them to a JSON file so runs with different weights can be compared.
+# The policy state is (control actuators, controlled outputs, targets), so the first entries are
+# the current actions as SB2_model's bavg blending expects; actions are absolute actuator values.
+
+default_controls = ['Ip [MA]', 'Pnb1a [MW]', 'Pnb1b [MW]', 'Pnb1c [MW]', 'Elon. [-]', 'Up.Tri. [-]', 'Lo.Tri [-]', 'In.Mid. [m]', 'Out.Mid. [m]']
+
+def state_bounds(controls=default_controls, targets=default_targets):
+    # Default low/high state and action bounds for policies trained on this state layout
+    control_index = [input_params.index(p) for p in controls]
+    low_target, high_target = np.array([targets[p] for p in targets], dtype=float).T
+    low_action, high_action = np.array(input_mins)[control_index], np.array(input_maxs)[control_index]
+    return np.concatenate([low_action, low_target, low_target]), np.concatenate([high_action, high_target, high_target]), low_action, high_action
+
+def sample_targets(n_scenarios, targets=default_targets, seed=0):
+    low, high = np.array([targets[p] for p in targets], dtype=float).T
+    return np.random.default_rng(seed).uniform(low, high, (n_scenarios, len(low)))
+
+def run_closed_loop(policy, targets, target_names=list(default_targets), controls=default_controls, steps=100,
+                    boundary=True, settle=0.5, warmup=2, **kwargs):
+    # targets: (S, len(target_names)), one discharge per row; kwargs go to BatchKSTARSimulator
+    targets = np.atleast_2d(np.asarray(targets, dtype=float))
+    kwargs.setdefault('backend', 'numpy')
+    sim = BatchKSTARSimulator(len(targets), **kwargs)
+    control_index = np.array([input_params.index(p) for p in controls])
+    target_index = np.array([output_params2.index(p) for p in target_names])
+    low, high = np.array(input_mins, dtype=float), np.array(input_maxs, dtype=float)
+
+    # Per-stage latency from the shared profiler, which the simulator already reports to
+    enabled = profiler.enabled
+    profiler.enabled = True
+    try:
+        u = np.tile(np.array(input_init, dtype=float), (len(targets), 1))
+        y = sim.step(u)
+        for i in range(warmup):
+            policy.predict(np.concatenate([u[:, control_index], y[:, target_index], targets], axis=1))
+        profiler.reset()
+
+        ys = np.zeros([steps, len(targets), len(output_params2)])
+        start = time.perf_counter()
+        for i in range(steps):
+            with profiler.stage('policy'):
+                actions = policy.predict(np.concatenate([u[:, control_index], y[:, target_index], targets], axis=1))
+            u[:, control_index] = np.clip(actions, low[control_index], high[control_index])
+            y = ys[i] = sim.step(u)
+            if boundary:
+                sim.predict_boundaries(u)
+        elapsed = time.perf_counter() - start
+        latency = profiler.summary()
+    finally:
+        profiler.enabled = enabled
+
+    # Tracking error after the first settle fraction of the discharge
+    error = np.abs(ys[int(settle * steps):, :, target_index] - targets)
+    scale = np.array([np.ptp(default_targets[p]) if p in default_targets else 1. for p in target_names])
+    return {
+        'n_scenarios': len(targets), 'steps': steps, 'elapsed_s': elapsed,
+        'loop_steps_per_s': steps / elapsed, 'control_steps_per_s': steps * len(targets) / elapsed,
+        'latency': latency,
+        'tracking_error': {p: {'mae': float(np.mean(error[..., j])), 'max': float(np.max(error[..., j]))} for j, p in enumerate(target_names)},
+        'tracking_error_normalized': float(np.mean(error / scale)),
+    }
+
+if __name__ == '__main__':
+    from common.model_structure import SB2_ensemble
+    parser = argparse.ArgumentParser(description='Closed-loop SB2 policy benchmark against KSTAR-NN')
+    parser.add_argument('--policy', nargs='+', required=True, help='SB2 model zip files forming the ensemble')
+    parser.add_argument('--n-scenarios', type=int, default=64)
+    parser.add_argument('--steps', type=int, default=100)
+    parser.add_argument('--n-models', type=int, default=1)
+    parser.add_argument('--backend', default='numpy')
+    parser.add_argument('--bavg', type=float, default=0.)
+    parser.add_argument('--no-boundary', action='store_true')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='closed_loop.json')
+    args = parser.parse_args()
+
+    policy = SB2_ensemble(args.policy, *state_bounds(), bavg=args.bavg)
+    results = run_closed_loop(policy, sample_targets(args.n_scenarios, seed=args.seed), steps=args.steps, boundary=not args.no_boundary,
+                              n_models=args.n_models, max_models=args.n_models, backend=args.backend)
+    results.update({'policy': args.policy, 'n_models': args.n_models, 'backend': args.backend, 'seed': args.seed})
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"{results['control_steps_per_s']:.0f} control steps/s, normalized tracking error {results['tracking_error_normalized']:.3f} -> {args.output}")
@@ -0,0 +1,76 @@
+import numpy as np
+from common.simulator import BatchKSTARSimulator, input_params, input_mins, input_maxs, input_init, output_params2
+
+# Vectorized Gym-style environment: N discharges advanced in lockstep by one BatchKSTARSimulator.
+# Actions are actuator changes in [-1, 1] scaled by max_delta of each actuator's range per 0.1 s step;
+# the reward is the normalized tracking error of the target outputs, which are sampled per episode.
+# step() follows the Gym/SB2 VecEnv API, (obs, reward, done, info), with automatic reset.
+
+default_targets = {'betan': (1.0, 2.8), 'q95': (3.0, 7.0), 'li': (0.8, 1.2)}
+
+class KSTAREnv():
+    def __init__(self, n_envs=16, targets=default_targets, controls=input_params, observation='outputs',
+                 episode_steps=100, max_delta=0.05, random_init=False, seed=None, **kwargs):
+        # controls: actuators driven by the action, the others stay at their initial value
+        # observation: 'outputs' (latest outputs, actuators and targets) or 'window' (LSTM window and targets)
+        kwargs.setdefault('backend', 'numpy')
+        self.sim = BatchKSTARSimulator(n_envs, **kwargs)
+        self.n_envs, self.episode_steps, self.random_init = n_envs, episode_steps, random_init
+        self.observation = observation
+        self.rng = np.random.default_rng(seed)
+
+        self.control_index = np.array([input_params.index(p) for p in controls])
+        self.low, self.high = np.array(input_mins, dtype=float), np.array(input_maxs, dtype=float)
+        self.delta = max_delta * (self.high - self.low)[self.control_index]
+        self.target_names = list(targets.keys())
+        self.target_index = np.array([output_params2.index(p) for p in self.target_names])
+        self.target_low, self.target_high = np.array([targets[p] for p in self.target_names], dtype=float).T
+        self.target_scale = self.target_high - self.target_low
+
+        self.action_low, self.action_high = -np.ones(len(controls)), np.ones(len(controls))
+        self.actuators = np.tile(np.array(input_init, dtype=float), (n_envs, 1))
+        self.targets = np.zeros([n_envs, len(self.target_names)])
+        self.steps = np.zeros(n_envs, dtype=int)
+        self.y = np.zeros([n_envs, len(output_params2)])
+
+    @property
+    def observation_size(self):
+        return len(self.get_observation()[0])
+
+    def get_observation(self):
+        if self.observation == 'window':
+            x = self.sim.state.x if self.sim.state.n_members is None else np.mean(self.sim.state.x, axis=0)
+            return np.concatenate([x.reshape(self.n_envs, -1), self.targets], axis=1)
+        return np.concatenate([self.y, self.actuators, self.targets], axis=1)
+
+    def reset(self, mask=None):
+        # Starts new discharges for mask (all by default) from a steady state; returns the observations
+        rows = np.arange(self.n_envs) if mask is None else np.flatnonzero(mask)
+        if len(rows) > 0:
+            init = self.rng.uniform(self.low, self.high, (len(rows), len(input_params))) if self.random_init else input_init
+            self.actuators[rows] = init
+            self.targets[rows] = self.rng.uniform(self.target_low, self.target_high, (len(rows), len(self.target_names)))
+            self.steps[rows] = 0
+            self.sim.reset(None if mask is None else rows)
+            self.y[rows] = self.sim.step(self.actuators, rows=rows)
+        return self.get_observation()
+
+    def reward(self, y, targets):
+        return -np.sum(np.abs(y[:, self.target_index] - targets) / self.target_scale, axis=1)
+
+    def step(self, actions):
+        actions = np.clip(np.asarray(actions, dtype=float), self.action_low, self.action_high)
+        self.actuators[:, self.control_index] += actions * self.delta
+        self.actuators[:] = np.clip(self.actuators, self.low, self.high)
+        self.y[:] = self.sim.step(self.actuators)
+        self.steps += 1
+
+        reward = self.reward(self.y, self.targets)
+        done = self.steps >= self.episode_steps
+        obs = self.get_observation()
+        info = [{} for i in range(self.n_envs)]
+        if np.any(done):
+            for i in np.flatnonzero(done):
+                info[i]['terminal_observation'] = obs[i].copy()
+            obs = self.reset(done)
+        return obs, reward, done, info
@@ -0,0 +1,92 @@
+import numpy as np
+from matplotlib.path import Path
+from common.wall import Rwalls, Zwalls
+
+# Divertor strike legs below the lower X-point, extrapolated from the last boundary points
+# and clipped to the wall. Works on a batch of boundaries so scans can compute footprints
+# without plotting; the GUIs only draw the returned arrays.
+
+wall_path = Path(np.array([Rwalls, Zwalls]).T)
+
+# (interp1d kind, whether the X-point itself is part of the fitted points), as the GUIs always drew them
+heat_load_fits = [('linear', False), ('quadratic', False), ('linear', True), ('quadratic', True)]
+fit_points = 5
+
+def linear_extrapolate(t, v, t_eval):
+    # Batched interp1d(kind='linear', fill_value='extrapolate'): (B, k) points evaluated at (B, n),
+    # outside the points the nearest end segment is extended
+    order = np.argsort(t, axis=1)
+    t, v = np.take_along_axis(t, order, axis=1), np.take_along_axis(v, order, axis=1)
+    hi = np.clip(np.sum(t[:, None, :] < t_eval[:, :, None], axis=2), 1, t.shape[1] - 1)
+    t0, t1 = np.take_along_axis(t, hi - 1, axis=1), np.take_along_axis(t, hi, axis=1)
+    v0, v1 = np.take_along_axis(v, hi - 1, axis=1), np.take_along_axis(v, hi, axis=1)
+    return v0 + (v1 - v0) / (t1 - t0) * (t_eval - t0)
+
+def bspline_basis(knots, x, k):
+    # Values (B, n, m - k - 1) of the degree-k B-splines on (B, m) knots at (B, n) points. Points
+    # outside the base interval use the polynomial piece of the end interval, as scipy extrapolates.
+    m = knots.shape[1]
+    span = np.clip(np.sum(knots[:, None, :] <= x[:, :, None], axis=2) - 1, k, m - k - 2)
+    at = lambda offset: np.take_along_axis(knots, span + offset, axis=1)
+    basis = [np.ones_like(x)]
+    for j in range(1, k + 1):
+        saved = np.zeros_like(x)
+        for r in range(j):
+            right, left = at(r + 1) - x, x - at(1 - j + r)
+            temp = basis[r] / (right + left)
+            basis[r], saved = saved + right * temp, left * temp
+        basis.append(saved)
+    values = np.zeros(x.shape + (m - k - 1,))
+    for r in range(k + 1):
+        np.put_along_axis(values, (span - k + r)[..., None], basis[r][..., None], axis=2)
+    return values
+
+def quadratic_extrapolate(t, v, t_eval):
+    # Batched interp1d(kind='quadratic', fill_value='extrapolate'): the k=2 interpolating spline of
+    # make_interp_spline, with knots at the interior midpoints except the first and last
+    order = np.argsort(t, axis=1)
+    t, v = np.take_along_axis(t, order, axis=1), np.take_along_axis(v, order, axis=1)
+    middle = 0.5 * (t[:, 1:] + t[:, :-1])
+    knots = np.concatenate([np.repeat(t[:, :1], 3, axis=1), middle[:, 1:-1], np.repeat(t[:, -1:], 3, axis=1)], axis=1)
+    coefficients = np.linalg.solve(bspline_basis(knots, t, 2), v[..., None])
+    return np.matmul(bspline_basis(knots, t_eval, 2), coefficients)[..., 0]
+
+def extrapolate(t, v, t_eval, kind):
+    return linear_extrapolate(t, v, t_eval) if kind == 'linear' else quadratic_extrapolate(t, v, t_eval)
+
+def heat_load_legs(rbdry, zbdry, n=10):
+    # rbdry, zbdry: (npts,) or (B, npts). Returns a dict of
+    #   r, z: (B, fits, 2, n) leg coordinates, leg 0 is parametrized in R and leg 1 in Z
+    #   inside: (B, fits, 2, n) whether each point lies inside the wall
+    #   visible: (B, fits, 2) whether the leg is drawn on the X-point side, index: (B,) X-point index
+    # with the batch axis dropped for a single boundary
+    rbdry, zbdry = np.asarray(rbdry, dtype=float), np.asarray(zbdry, dtype=float)
+    single = rbdry.ndim == 1
+    rbdry, zbdry = np.atleast_2d(rbdry), np.atleast_2d(zbdry)
+    nb, npts = rbdry.shape
+    idx1 = np.argmin(zbdry, axis=1)
+
+    def take(values, offsets):
+        return np.take_along_axis(values, (idx1[:, None] + np.asarray(offsets)) % npts, axis=1)
+
+    s = np.linspace(0, 1, n)
+    rx, zx = take(rbdry, [0])[:, 0], take(zbdry, [0])[:, 0]
+    rsol1 = rx[:, None] + (np.min(Rwalls) + 1.e-4 - rx[:, None]) * s
+    zsol2 = zx[:, None] + (np.min(Zwalls) + 1.e-4 - zx[:, None]) * s
+    znext = take(zbdry, [1])
+
+    r, z = np.zeros([nb, len(heat_load_fits), 2, n]), np.zeros([nb, len(heat_load_fits), 2, n])
+    for i, (kind, with_xpt) in enumerate(heat_load_fits):
+        # Leg 1 follows z(R) of the points before the X-point, leg 2 R(z) of the points after it
+        before = np.arange(-fit_points, 1 if with_xpt else 0)
+        after = np.arange(fit_points, -1 if with_xpt else 0, -1)
+        r[:, i, 0], z[:, i, 0] = rsol1, extrapolate(take(rbdry, before), take(zbdry, before), rsol1, kind)
+        z[:, i, 1], r[:, i, 1] = zsol2, extrapolate(take(zbdry, after), take(rbdry, after), zsol2, kind)
+
+    inside = wall_path.contains_points(np.stack([r.ravel(), z.ravel()], axis=1)).reshape(r.shape)
+    visible = np.ones([nb, len(heat_load_fits), 2], dtype=bool)
+    # Leg 1 is dropped when all of its points inside the wall are above the boundary next to the X-point
+    visible[:, :, 0] = np.any(inside[:, :, 0] & (z[:, :, 0] <= znext[:, :, None]), axis=-1)
+
+    legs = {'r': r, 'z': z, 'inside': inside, 'visible': visible, 'index': idx1}
+    return {key: value[0] for key, value in legs.items()} if single else legs
@@ -1,6 +1,21 @@
-import json, zipfile
+import json, zipfile, threading
 import numpy as np
+import tensorflow as tf
 from tensorflow.keras import models, layers
+from common.numpy_models import k2rz_post, k2rz_post_members, k2rz_post_batch
+
+# Batches up to this size skip Model.predict and go through a traced function
+fast_predict_max_batch = 256
+fast_predict_functions = {}
+
+def fast_predict(model, x):
+    x = np.asarray(x, dtype=np.float32)
+    if len(x) > fast_predict_max_batch:
+        return model.predict(x)
+    if id(model) not in fast_predict_functions:
+        spec = tf.TensorSpec(shape=(None,) + tuple(model.input_shape[1:]), dtype=tf.float32)
+        fast_predict_functions[id(model)] = (model, tf.function(lambda x: model(x, training=False), input_signature=[spec]))
+    return fast_predict_functions[id(model)][1](x).numpy()
 
 class k2rz():
     def __init__(self, model_path, n_models=1, ntheta=64, closed_surface=True, xpt_correction=True):
@@ -12,31 +27,22 @@ class k2rz():
         self.x = np.array([ip, bt, βp, rin, rout, k, du, dl])
 
     def predict(self, post=True):
-        self.y = np.mean([m.predict(np.array([self.x]))[0] for m in self.models[:self.nmodels]], axis=0)
+        self.y = np.mean([fast_predict(m, [self.x])[0] for m in self.models[:self.nmodels]], axis=0)
         rbdry, zbdry = self.y[:self.ntheta], self.y[self.ntheta:]
         if post:
-            if self.xpt_correction:
-                rgeo, amin = 0.5 * (max(rbdry) + min(rbdry)), 0.5 * (max(rbdry) - min(rbdry))
-                if self.x[6] <= self.x[7]:
-                    rx = rgeo - amin * self.x[7]
-                    zx = max(zbdry) - 2 * self.x[5] * amin
-                    rx2 = rgeo - amin * self.x[6]
-                    rbdry[np.argmin(zbdry)] = rx
-                    zbdry[np.argmin(zbdry)] = zx
-                    rbdry[np.argmax(zbdry)] = rx2
-                else:
-                    rx = rgeo - amin * self.x[6]
-                    zx = min(zbdry) + 2 * self.x[5] * amin
-                    rx2 = rgeo - amin * self.x[7]
-                    rbdry[np.argmax(zbdry)] = rx
-                    zbdry[np.argmax(zbdry)] = zx
-                    rbdry[np.argmin(zbdry)] = rx2
-            
-            if self.closed_surface:
-                rbdry, zbdry = np.append(rbdry, rbdry[0]), np.append(zbdry, zbdry[0])
+            rbdry, zbdry = k2rz_post(self.x, rbdry, zbdry, self.closed_surface, self.xpt_correction)
 
         return rbdry, zbdry
 
+    def predict_members(self, post=True):
+        self.ys = np.array([fast_predict(m, [self.x])[0] for m in self.models[:self.nmodels]])
+        return k2rz_post_members(self.x, self.ys, self.ntheta, post, self.closed_surface, self.xpt_correction)
+
+    def predict_batch(self, xs, post=True):
+        # Ensemble-mean boundaries for (B, 8) inputs
+        ys = np.mean([fast_predict(m, xs) for m in self.models[:self.nmodels]], axis=0)
+        return k2rz_post_batch(xs, ys, self.ntheta, post, self.closed_surface, self.xpt_correction)
+
 class x2rz():
     def __init__(self, model_path, n_models=1, ntheta=64, closed_surface=True, xpt_correction=True):
         self.nmodels, self.ntheta = n_models, ntheta
@@ -47,7 +53,7 @@ class x2rz():
         self.x = np.array([ip, bt, βp, rx1, zx1, rx2, zx2, drsep, rin, rout])
 
     def predict(self, post=True):
-        self.y = np.mean([m.predict(np.array([self.x]))[0] for m in self.models[:self.nmodels]], axis=0)
+        self.y = np.mean([fast_predict(m, [self.x])[0] for m in self.models[:self.nmodels]], axis=0)
         rbdry, zbdry = self.y[:self.ntheta], self.y[self.ntheta:]
         if post:
             if self.xpt_correction:
@@ -78,6 +84,64 @@ def load_custom_model(input_shape, lstms, denses, model_path):
     model.load_weights(model_path)
     return model
 
+def ensemble_model(members, per_member=False):
+    # Merge the members into one graph whose output is stacked as (batch, n_members, n_outputs)
+    # With per_member=True the input is (batch, n_members, ...) and member i only sees its own slice
+    shape = members[0].input_shape[1:]
+    if per_member:
+        x = layers.Input(shape=(len(members),) + shape)
+        xs = [layers.Lambda(lambda t, i=i: t[:, i])(x) for i in range(len(members))]
+    else:
+        x = layers.Input(shape=shape)
+        xs = [x] * len(members)
+    ys = [layers.Reshape((1, -1))(models.Sequential([m], name=f'member{i}')(xi)) for i, (m, xi) in enumerate(zip(members, xs))]
+    y = layers.Concatenate(axis=1)(ys) if len(ys) > 1 else ys[0]
+    return models.Model(inputs=x, outputs=y)
+
+class fused_ensemble():
+    def __init__(self):
+        self.keys, self.models = {}, {}
+
+    def __call__(self, members, per_member=False):
+        key = tuple(id(m) for m in members)
+        if key != self.keys.get(per_member):
+            fast_predict_functions.pop(id(self.models.get(per_member)), None)
+            self.keys[per_member], self.models[per_member] = key, ensemble_model(members, per_member)
+        return self.models[per_member]
+
+class lazy_ensemble():
+    # Members beyond the ones in use are deserialized on demand (or by a background prefetch)
+    def init_models(self, n_loaded, max_models):
+        self.models, self.max_models, self.lock = [], max_models, threading.Lock()
+        self.load_models(n_loaded)
+
+    def load_models(self, n):
+        # The lock is taken per member, so asking for members that are already loaded
+        # returns at once and a running prefetch only delays callers by one member
+        while len(self.models) < min(n, self.max_models):
+            with self.lock:
+                if len(self.models) < min(n, self.max_models):
+                    self.models.append(self.load_model(len(self.models)))
+
+    def prefetch(self, n=None):
+        thread = threading.Thread(target=self.load_models, args=(self.max_models if n is None else n,), daemon=True)
+        thread.start()
+        return thread
+
+    def shuffle(self):
+        with self.lock:
+            np.random.shuffle(self.models)
+
+def ensemble_predict(ensemble, x, per_member=False):
+    # Returns (members, batch, outputs); with per_member=True x is (members, batch, ...)
+    ensemble.load_models(ensemble.nmodels)
+    members = ensemble.models[:ensemble.nmodels]
+    if ensemble.fused:
+        x = np.swapaxes(x, 0, 1) if per_member else x
+        return np.swapaxes(fast_predict(ensemble.fused_ensemble(members, per_member), x), 0, 1) * ensemble.ystd + ensemble.ymean
+    xs = x if per_member else [x] * len(members)
+    return np.array([fast_predict(m, xm) * ensemble.ystd + ensemble.ymean for m, xm in zip(members, xs)])
+
 class kstar_lstm():
     def __init__(self, model_path, n_models=1, ymean=None, ystd=None):
         self.nmodels = n_models
@@ -94,26 +158,40 @@ class kstar_lstm():
     def predict(self, x=None):
         if type(x) == type(np.zeros(1)):
             self.set_inputs(x)
-        self.y = np.mean([m.predict(self.x)[0] * self.ystd + self.ymean for m in self.models[:self.nmodels]], axis=0)
+        self.y = np.mean([fast_predict(m, self.x)[0] * self.ystd + self.ymean for m in self.models[:self.nmodels]], axis=0)
         return self.y
 
-class kstar_v220505():
-    def __init__(self, model_path, n_models=1, ymean=None, ystd=None, length=10):
+class kstar_v220505(lazy_ensemble):
+    def __init__(self, model_path, n_models=1, ymean=None, ystd=None, length=10, fused=False, max_models=None):
         if ymean is None or ystd is None:
             self.ymean = [1.4361666, 5.275876, 1.534538, 1.1268075]
             self.ystd = [0.7294007, 1.5010427, 0.6472052, 0.2331879]
         else:
             self.ymean, self.ystd = ymean, ystd
         self.nmodels = n_models
-        self.models = [load_custom_model((length, 18), [100, 100], [50, 4], model_path + f'/best_model{i}') for i in range(self.nmodels)]
+        self.model_path, self.length = model_path, length
+        self.fused, self.fused_ensemble = fused, fused_ensemble()
+        self.init_models(n_models, n_models if max_models is None else max_models)
+
+    def load_model(self, i):
+        return load_custom_model((self.length, 18), [100, 100], [50, 4], self.model_path + f'/best_model{i}')
 
     def set_inputs(self, x):
         self.x = np.array(x) if len(np.shape(x)) == 3 else np.array([x])
 
-    def predict(self, x=None):
-        if type(x) == type(np.zeros(1)):
+    def predict_ensemble(self, x=None, per_member=False):
+        if per_member:
+            self.x = np.array(x)
+        elif type(x) == type(np.zeros(1)):
             self.set_inputs(x)
-        self.y = np.mean([m.predict(self.x)[0] * self.ystd + self.ymean for m in self.models[:self.nmodels]], axis=0)
+        return ensemble_predict(self, self.x, per_member)
+
+    def predict_members(self, x=None):
+        self.ys = self.predict_ensemble(x)[:, 0]
+        return self.ys
+
+    def predict(self, x=None):
+        self.y = np.mean(self.predict_members(x), axis=0)
         return self.y
 
 class kstar_nn():
@@ -129,10 +207,15 @@ class kstar_nn():
     def set_inputs(self, x):
         self.x = np.array(x) if len(np.shape(x)) == 2 else np.array([x])
 
+    def predict_ensemble(self, x=None):
+        if type(x) == type(np.zeros(1)):
+            self.set_inputs(x)
+        return np.array([fast_predict(m, self.x) * self.ystd + self.ymean for m in self.models[:self.nmodels]])
+
     def predict(self, x=None):
         if type(x) == type(np.zeros(1)):
             self.set_inputs(x)
-        self.y = np.mean([m.predict(self.x)[0] * self.ystd + self.ymean for m in self.models[:self.nmodels]], axis=0)
+        self.y = np.mean([fast_predict(m, self.x)[0] * self.ystd + self.ymean for m in self.models[:self.nmodels]], axis=0)
         return self.y
 
 class bpw_nn():
@@ -148,26 +231,41 @@ class bpw_nn():
     def predict(self, x=None):
         if type(x) == type(np.zeros(1)):
             self.set_inputs(x)
-        self.y = np.mean([m.predict(self.x)[0] * self.ystd + self.ymean for m in self.models[:self.nmodels]], axis=0)
+        self.y = np.mean([fast_predict(m, self.x)[0] * self.ystd + self.ymean for m in self.models[:self.nmodels]], axis=0)
         return self.y
 
-class tf_dense_model():
-    def __init__(self, model_path, n_models=1, ymean=0, ystd=1):
+class tf_dense_model(lazy_ensemble):
+    def __init__(self, model_path, n_models=1, ymean=0, ystd=1, fused=False, max_models=None):
         self.nmodels = n_models
         self.ymean, self.ystd = ymean, ystd
-        self.models = [models.load_model(model_path + f'/best_model{i}', compile=False) for i in range(n_models)]
+        self.model_path = model_path
+        self.fused, self.fused_ensemble = fused, fused_ensemble()
+        self.init_models(n_models, n_models if max_models is None else max_models)
+
+    def load_model(self, i):
+        return models.load_model(self.model_path + f'/best_model{i}', compile=False)
 
     def set_inputs(self, x):
         self.x = np.array(x) if len(np.shape(x)) == 2 else np.array([x])
 
+    def predict_ensemble(self, x, per_member=False):
+        if per_member:
+            self.x = np.array(x)
+        else:
+            self.set_inputs(x)
+        return ensemble_predict(self, self.x, per_member)
+
+    def predict_members(self, x):
+        self.ys = self.predict_ensemble(x)[:, 0]
+        return self.ys
+
     def predict(self, x):
-        self.set_inputs(x)
-        self.y = np.mean([m.predict(self.x)[0] * self.ystd + self.ymean for m in self.models[:self.nmodels]], axis=0)
+        self.y = np.mean(self.predict_members(x), axis=0)
         return self.y
 
 def actv(x, method):
     if method == 'relu':
-        return np.max([np.zeros_like(x), x], axis=0)
+        return np.maximum(x, 0)
     elif method == 'tanh':
         return np.tanh(x)
     elif method == 'sigmoid':
@@ -187,15 +285,15 @@ class SB2_model():
         self.activation, self.last_actv = activation, last_actv
         self.norm = norm
         self.bavg = bavg
+        # Policy layers (kernel, bias) read from the npz once, the last one is the output layer
+        names = [f'model/pi/fc{i}' for i in range(len(self.layers))] + ['model/pi/dense']
+        self.weights = [(self.parameters[f'{name}/kernel:0'], self.parameters[f'{name}/bias:0']) for name in names]
 
     def predict(self, x, yold=None):
         xnorm = 2 * (x - self.low_state) / np.subtract(self.high_state, self.low_state) - 1 if self.norm else x
         ynorm = xnorm
-        for i, layer in enumerate(self.layers):
-            w, b = self.parameters[f'model/pi/fc{i}/kernel:0'], self.parameters[f'model/pi/fc{i}/bias:0']
-            ynorm = actv(np.matmul(ynorm, w) + b, self.activation)
-        w, b = self.parameters[f'model/pi/dense/kernel:0'], self.parameters[f'model/pi/dense/bias:0']
-        ynorm = actv(np.matmul(ynorm, w) + b, self.last_actv)
+        for i, (w, b) in enumerate(self.weights):
+            ynorm = actv(np.matmul(ynorm, w) + b, self.activation if i < len(self.layers) else self.last_actv)
 
         y = 0.5 * np.subtract(self.high_action, self.low_action) * (ynorm + 1) + self.low_action if self.norm else ynorm
         if yold is None:
@@ -206,9 +304,31 @@ class SB2_model():
 class SB2_ensemble():
     def __init__(self, model_list, low_state, high_state, low_action, high_action, activation='relu', last_actv='tanh', norm=True, bavg=0.):
         self.models = [SB2_model(model_path, low_state, high_state, low_action, high_action, activation, last_actv, norm, bavg) for model_path in model_list]
+        if len(set(tuple(m.layers) for m in self.models)) > 1:
+            raise ValueError('SB2_ensemble members must share the same layers')
+        self.low_state, self.high_state = np.array(low_state, dtype=float), np.array(high_state, dtype=float)
+        self.low_action, self.high_action = np.array(low_action, dtype=float), np.array(high_action, dtype=float)
+        self.activation, self.last_actv = activation, last_actv
+        self.norm, self.bavg = norm, bavg
+        # Member weights stacked as (members, inputs, outputs) kernels and (members, 1, outputs) biases
+        self.kernels = [np.stack([m.weights[i][0] for m in self.models]) for i in range(len(self.models[0].weights))]
+        self.biases = [np.stack([m.weights[i][1] for m in self.models])[:, None] for i in range(len(self.models[0].weights))]
 
-    def predict(self, x):
-        ys = [m.predict(x) for m in self.models]
-        return np.mean(ys, axis=0)
+    def predict(self, x, yold=None):
+        # x is one state or a (batch, states) array; all members are evaluated with one einsum per layer
+        x = np.asarray(x, dtype=float)
+        xs = np.atleast_2d(x)
+        ynorm = 2 * (xs - self.low_state) / (self.high_state - self.low_state) - 1 if self.norm else xs
+        ynorm = np.einsum('bi,mio->mbo', ynorm, self.kernels[0]) + self.biases[0]
+        ynorm = actv(ynorm, self.activation if len(self.kernels) > 1 else self.last_actv)
+        for i in range(1, len(self.kernels)):
+            ynorm = actv(np.einsum('mbi,mio->mbo', ynorm, self.kernels[i]) + self.biases[i], self.activation if i < len(self.kernels) - 1 else self.last_actv)
+
+        # The bavg blend is linear, so it is applied once to the member mean
+        ynorm = np.mean(ynorm, axis=0)
+        y = 0.5 * (self.high_action - self.low_action) * (ynorm + 1) + self.low_action if self.norm else ynorm
+        yold = xs[:, :y.shape[-1]] if yold is None else np.atleast_2d(yold)
+        y = self.bavg * yold + (1 - self.bavg) * y
+        return y if x.ndim > 1 else y[0]
 
 
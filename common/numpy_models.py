@@ -0,0 +1,433 @@
+import numpy as np
+
+# Pure NumPy evaluation of the Keras ensembles, so that rollout workers do not need TensorFlow.
+# Weights are read from the Keras h5 files with h5py (or from an exported .npz) and stacked
+# over the ensemble members, i.e. every parameter array has a leading member axis.
+
+bn_epsilon = 1.e-3 # Keras default, used by load_custom_model and when a saved layer has no epsilon
+
+def sigmoid(x):
+    return 0.5 * (1 + np.tanh(0.5 * x))
+
+activations = {
+    'sigmoid': sigmoid,
+    'tanh': np.tanh,
+    'relu': lambda x: np.maximum(x, 0),
+    'linear': lambda x: x,
+}
+
+def read_h5_weights(model_path):
+    import h5py
+    with h5py.File(model_path, 'r') as f:
+        g = f['model_weights'] if 'model_weights' in f else f
+        weights = []
+        for name in g.attrs['layer_names']:
+            layer = g[name.decode() if type(name) == bytes else name]
+            for weight_name in layer.attrs['weight_names']:
+                weights.append(np.array(layer[weight_name.decode() if type(weight_name) == bytes else weight_name]))
+    return weights
+
+def read_h5_layers(model_path):
+    import h5py, json
+    with h5py.File(model_path, 'r') as f:
+        config = f.attrs['model_config']
+        config = json.loads(config.decode() if type(config) == bytes else config)
+        g = f['model_weights']
+        layers = []
+        for layer in config['config']['layers']:
+            name = layer['config']['name']
+            weights = [np.array(g[name][w.decode() if type(w) == bytes else w]) for w in g[name].attrs['weight_names']] if name in g else []
+            layers.append((layer['class_name'], layer['config'], weights))
+    return layers
+
+def fold_batch_normalization(gamma, beta, mean, var, epsilon=bn_epsilon):
+    scale = gamma / np.sqrt(var + epsilon)
+    return scale, beta - mean * scale
+
+def custom_parameters(weights, lstms, denses):
+    # Weight order of load_custom_model: BN, (LSTM, BN) * len(lstms), (Dense, BN) * (len(denses) - 1), Dense
+    weights, params = list(weights), {}
+    params['input/scale'], params['input/shift'] = fold_batch_normalization(*weights[:4])
+    del weights[:4]
+    for i in range(len(lstms)):
+        params[f'lstm{i}/kernel'], params[f'lstm{i}/recurrent_kernel'], params[f'lstm{i}/bias'] = weights[:3]
+        params[f'lstm{i}/scale'], params[f'lstm{i}/shift'] = fold_batch_normalization(*weights[3:7])
+        del weights[:7]
+    for i in range(len(denses) - 1):
+        params[f'dense{i}/kernel'], params[f'dense{i}/bias'] = weights[:2]
+        params[f'dense{i}/scale'], params[f'dense{i}/shift'] = fold_batch_normalization(*weights[2:6])
+        del weights[:6]
+    params[f'dense{len(denses) - 1}/kernel'], params[f'dense{len(denses) - 1}/bias'] = weights[:2]
+    return params
+
+def stack_parameters(params_list):
+    return {key: np.stack([p[key] for p in params_list]) for key in params_list[0].keys()}
+
+def open_weights(model_path):
+    # Stacked weights given directly (e.g. a weight_archive family) or as an exported .npz; None for Keras files
+    if type(model_path) == dict:
+        return model_path
+    if model_path.endswith('.npz'):
+        data = np.load(model_path)
+        return {key: data[key] for key in data.files}
+    return None
+
+def load_custom_weights(model_path, n_models, lstms, denses):
+    data = open_weights(model_path)
+    if data is not None:
+        return {key: value[:n_models] for key, value in data.items() if '/' in key}
+    return stack_parameters([custom_parameters(read_h5_weights(model_path + f'/best_model{i}'), lstms, denses) for i in range(n_models)])
+
+def export_custom_weights(model_path, n_models, lstms, denses, output_path):
+    params = load_custom_weights(model_path, n_models, lstms, denses)
+    np.savez(output_path, lstms=np.array(lstms), denses=np.array(denses), **params)
+    return output_path
+
+def dense_parameters(layers):
+    # BatchNormalization layers are merged into one scale/shift on the input of the following Dense
+    # (dense{i}/input_scale, dense{i}/input_shift); fold_dense_inputs folds them into float32 kernels
+    params, activation_list = {}, []
+    scale, shift = None, None
+    for class_name, config, weights in layers:
+        if class_name == 'BatchNormalization':
+            s, t = fold_batch_normalization(*[np.float64(w) for w in weights], config.get('epsilon', bn_epsilon))
+            scale, shift = (s, t) if scale is None else (scale * s, shift * s + t)
+        elif class_name == 'Dense':
+            i = len(activation_list)
+            if scale is not None:
+                params[f'dense{i}/input_scale'], params[f'dense{i}/input_shift'] = np.float32(scale), np.float32(shift)
+                scale, shift = None, None
+            params[f'dense{i}/kernel'], params[f'dense{i}/bias'] = np.float32(weights[0]), np.float32(weights[1])
+            activation_list.append(config['activation'])
+        elif class_name not in ['Dropout', 'GaussianNoise', 'InputLayer']:
+            raise ValueError(f'Unsupported layer for the NumPy dense engine: {class_name}')
+    if scale is not None:
+        raise ValueError('Trailing BatchNormalization is not supported by the NumPy dense engine')
+    return params, activation_list
+
+def load_dense_weights(model_path, n_models):
+    data = open_weights(model_path)
+    if data is not None:
+        return {key: value[:n_models] for key, value in data.items() if '/' in key}, [str(a) for a in data['activations']]
+    params_list, activation_list = zip(*[dense_parameters(read_h5_layers(model_path + f'/best_model{i}')) for i in range(n_models)])
+    return stack_parameters(params_list), activation_list[0]
+
+def export_dense_weights(model_path, n_models, output_path):
+    params, activation_list = load_dense_weights(model_path, n_models)
+    np.savez(output_path, activations=np.array(activation_list), **params)
+    return output_path
+
+def reduce_precision(params, precision='float32', keep=[]):
+    # Kernels stored as float16, or as int8 with float32 scales per member and input row (key + ':rows')
+    # and per member and output channel (key + ':scale'), so that rows of small weights (e.g. inputs that
+    # barely vary) do not round to zero. Biases, BatchNormalization and the kernels in keep stay float32.
+    if precision not in ['float32', 'float16', 'int8']:
+        raise ValueError(f'Unknown precision: {precision}')
+    reduced = {}
+    for key, value in params.items():
+        if precision == 'float32' or not key.endswith('kernel') or key in keep or value.dtype.itemsize < 4:
+            reduced[key] = value
+        elif precision == 'float16':
+            reduced[key] = value.astype(np.float16)
+        else:
+            rows = np.maximum(np.max(np.abs(value), axis=-1), 1.e-30)
+            value = value / rows[..., None]
+            scale = np.maximum(np.max(np.abs(value), axis=-2), 1.e-12) / 127
+            reduced[key] = np.clip(np.rint(value / scale[..., None, :]), -127, 127).astype(np.int8)
+            reduced[key + ':rows'], reduced[key + ':scale'] = np.float32(rows), np.float32(scale)
+    return reduced
+
+def fold_dense_inputs(params):
+    # Folds the input BatchNormalization of each float32 Dense kernel into its kernel and bias. Reduced
+    # kernels keep it as float32 vectors: folded, the rounding error of a row scales with the raw input
+    # instead of its normalized deviation, which is far smaller after saturated sigmoids or for the year.
+    params = dict(params)
+    for key in [key for key in params if key.endswith('/input_scale')]:
+        layer = key[:-len('/input_scale')]
+        if params[layer + '/kernel'].dtype == np.float32:
+            w = np.float64(params[layer + '/kernel'])
+            scale, shift = np.float64(params.pop(key)), np.float64(params.pop(layer + '/input_shift'))
+            params[layer + '/kernel'] = np.float32(scale[..., None] * w)
+            params[layer + '/bias'] = np.float32(params[layer + '/bias'] + np.matmul(shift[:, None], w)[:, 0])
+    return params
+
+def dequantize(params, key, n_models=None, out=None):
+    # float32 kernel of the first n_models members: a slice for float32, otherwise expanded into out
+    value = params[key][:n_models]
+    if value.dtype == np.float32:
+        return value
+    out = np.empty(value.shape, dtype=np.float32) if out is None else out
+    if value.dtype == np.int8:
+        np.multiply(value, params[key + ':scale'][:n_models, None, :], out=out)
+        out *= params[key + ':rows'][:n_models, :, None]
+    else:
+        out[...] = value
+    return out
+
+def parameter_bytes(params):
+    return sum(value.nbytes for value in params.values())
+
+class reduced_kernels():
+    # Reduced kernels are expanded into a float32 scratch buffer sized for the largest kernel of one
+    # member, and the ensemble is then evaluated one member at a time, so no float32 copy of the
+    # weights is kept. A kernel returned by kernel() is only valid until the next call.
+    def __init__(self, params):
+        sizes = [value[0].size for key, value in params.items() if key.endswith('kernel') and value.dtype != np.float32]
+        self.scratch = np.empty(max(sizes, default=0), dtype=np.float32)
+
+    def kernel(self, params, key):
+        value = params[key]
+        out = None if value.dtype == np.float32 else self.scratch[:value.size].reshape(value.shape)
+        return dequantize(params, key, out=out)
+
+    def evaluate(self, function, params, y, n_models=None):
+        # function(params, y) on the first n_models members; y has a leading member axis of 1 or n_models
+        if not self.scratch.size:
+            return function({key: value[:n_models] for key, value in params.items()}, y)
+        n = len(next(iter(params.values()))[:n_models])
+        return np.concatenate([function({key: value[m:m + 1] for key, value in params.items()}, y[m:m + 1] if len(y) > 1 else y)
+                               for m in range(n)])
+
+    def nbytes(self):
+        return self.scratch.nbytes
+
+def batch_normalization(x, scale, shift):
+    # scale/shift are (members, features), x is (members, ..., features)
+    shape = (len(scale),) + (1,) * (x.ndim - 2) + (scale.shape[-1],)
+    return x * scale.reshape(shape) + shift.reshape(shape)
+
+def lstm_layer(z, recurrent_kernel, return_sequences):
+    # z = x @ kernel + bias is (members, batch, time, 4 * units); gates are ordered as i, f, c, o like Keras
+    nm, nb, nt = z.shape[:3]
+    units = recurrent_kernel.shape[1]
+    h = np.zeros([nm, nb, units], dtype=z.dtype)
+    c = np.zeros([nm, nb, units], dtype=z.dtype)
+    hs = []
+    for t in range(nt):
+        g = z[:, :, t] + np.matmul(h, recurrent_kernel)
+        i, f, o = sigmoid(g[..., :units]), sigmoid(g[..., units:2 * units]), sigmoid(g[..., 3 * units:])
+        c = f * c + i * np.tanh(g[..., 2 * units:3 * units])
+        h = o * np.tanh(c)
+        if return_sequences:
+            hs.append(h)
+    return np.stack(hs, axis=2) if return_sequences else h
+
+class np_dense_model():
+    def __init__(self, params, activation_list, precision='float32'):
+        self.params, self.activations = fold_dense_inputs(reduce_precision(params, precision)), activation_list
+        self.dtype = params['dense0/bias'].dtype
+        self.kernels = reduced_kernels(self.params)
+
+    def shuffle(self):
+        idx = np.random.permutation(len(self.params['dense0/kernel']))
+        self.params = {key: value[idx] for key, value in self.params.items()}
+
+    def nbytes(self):
+        # Resident weight memory: the stored parameters and the scratch buffer for reduced kernels
+        return parameter_bytes(self.params) + self.kernels.nbytes()
+
+    def evaluate(self, p, y):
+        for i, activation in enumerate(self.activations):
+            if f'dense{i}/input_scale' in p:
+                y = batch_normalization(y, p[f'dense{i}/input_scale'], p[f'dense{i}/input_shift'])
+            y = np.matmul(y, self.kernels.kernel(p, f'dense{i}/kernel')) + p[f'dense{i}/bias'][:, None]
+            y = activations[activation](y)
+        return y
+
+    def predict(self, x, n_models=None, per_member=False):
+        # x is (batch, features), or (members, batch, features) with per_member=True; returns (members, batch, outputs)
+        y = np.asarray(x, dtype=self.dtype)
+        return self.kernels.evaluate(self.evaluate, self.params, y if per_member else y[None], n_models)
+
+class np_custom_model():
+    def __init__(self, params, lstms, denses, precision='float32'):
+        self.params, self.lstms, self.denses = reduce_precision(params, precision), lstms, denses
+        self.dtype = params['input/scale'].dtype
+        self.kernels = reduced_kernels(self.params)
+
+    def shuffle(self):
+        idx = np.random.permutation(len(self.params['input/scale']))
+        self.params = {key: value[idx] for key, value in self.params.items()}
+
+    def nbytes(self):
+        # Resident weight memory: the stored parameters and the scratch buffer for reduced kernels
+        return parameter_bytes(self.params) + self.kernels.nbytes()
+
+    def evaluate(self, p, y):
+        kernel = lambda key: self.kernels.kernel(p, key)
+        y = batch_normalization(y, p['input/scale'], p['input/shift'])
+        for i in range(len(self.lstms)):
+            # The input projection is taken before the recurrent kernel reuses the scratch buffer
+            z = np.matmul(y, kernel(f'lstm{i}/kernel')[:, None]) + p[f'lstm{i}/bias'][:, None, None]
+            y = lstm_layer(z, kernel(f'lstm{i}/recurrent_kernel'), i < len(self.lstms) - 1)
+            y = batch_normalization(y, p[f'lstm{i}/scale'], p[f'lstm{i}/shift'])
+        for i in range(len(self.denses)):
+            y = np.matmul(y, kernel(f'dense{i}/kernel')) + p[f'dense{i}/bias'][:, None]
+            if i < len(self.denses) - 1:
+                y = batch_normalization(sigmoid(y), p[f'dense{i}/scale'], p[f'dense{i}/shift'])
+        return y
+
+    def predict(self, x, n_models=None, per_member=False):
+        # x is (batch, time, features), or (members, batch, time, features) with per_member=True; returns (members, batch, outputs)
+        y = np.asarray(x, dtype=self.dtype)
+        return self.kernels.evaluate(self.evaluate, self.params, y if per_member else y[None], n_models)
+
+def k2rz_post(x, rbdry, zbdry, closed_surface=True, xpt_correction=True):
+    if xpt_correction:
+        rgeo, amin = 0.5 * (max(rbdry) + min(rbdry)), 0.5 * (max(rbdry) - min(rbdry))
+        if x[6] <= x[7]:
+            rx = rgeo - amin * x[7]
+            zx = max(zbdry) - 2 * x[5] * amin
+            rx2 = rgeo - amin * x[6]
+            rbdry[np.argmin(zbdry)] = rx
+            zbdry[np.argmin(zbdry)] = zx
+            rbdry[np.argmax(zbdry)] = rx2
+        else:
+            rx = rgeo - amin * x[6]
+            zx = min(zbdry) + 2 * x[5] * amin
+            rx2 = rgeo - amin * x[7]
+            rbdry[np.argmax(zbdry)] = rx
+            zbdry[np.argmax(zbdry)] = zx
+            rbdry[np.argmin(zbdry)] = rx2
+
+    if closed_surface:
+        rbdry, zbdry = np.append(rbdry, rbdry[0]), np.append(zbdry, zbdry[0])
+
+    return rbdry, zbdry
+
+def k2rz_post_members(x, ys, ntheta=64, post=True, closed_surface=True, xpt_correction=True):
+    # Per-member boundaries (members, 2 * ntheta) -> rbdrys, zbdrys (members, ntheta (+1))
+    ys = np.array(ys, dtype=float)
+    rz = [(y[:ntheta], y[ntheta:]) for y in ys]
+    if post:
+        rz = [k2rz_post(x, rbdry, zbdry, closed_surface, xpt_correction) for rbdry, zbdry in rz]
+    return np.array([r for r, z in rz]), np.array([z for r, z in rz])
+
+def k2rz_post_batch(xs, ys, ntheta=64, post=True, closed_surface=True, xpt_correction=True):
+    # Boundaries (B, 2 * ntheta) of the inputs xs (B, 8) -> rbdrys, zbdrys (B, ntheta (+1))
+    ys = np.array(ys, dtype=float)
+    rz = [(y[:ntheta], y[ntheta:]) for y in ys]
+    if post:
+        rz = [k2rz_post(x, rbdry, zbdry, closed_surface, xpt_correction) for x, (rbdry, zbdry) in zip(xs, rz)]
+    return np.array([r for r, z in rz]), np.array([z for r, z in rz])
+
+def ensemble_bands(ys, axis=0, percentiles=(5, 95)):
+    # Mean, standard deviation and percentile band over the member axis
+    lower, upper = np.percentile(ys, percentiles, axis=axis)
+    return {'mean': np.mean(ys, axis=axis), 'std': np.std(ys, axis=axis), 'lower': lower, 'upper': upper}
+
+class np_k2rz():
+    def __init__(self, model_path, n_models=1, ntheta=64, closed_surface=True, xpt_correction=True, precision='float32'):
+        self.nmodels, self.ntheta = n_models, ntheta
+        self.closed_surface, self.xpt_correction = closed_surface, xpt_correction
+        self.model = np_dense_model(*load_dense_weights(model_path, n_models), precision)
+
+    def set_inputs(self, ip, bt, βp, rin, rout, k, du, dl):
+        self.x = np.array([ip, bt, βp, rin, rout, k, du, dl])
+
+    def predict(self, post=True):
+        self.y = np.mean(self.model.predict([self.x], self.nmodels)[:, 0], axis=0, dtype=float)
+        rbdry, zbdry = self.y[:self.ntheta], self.y[self.ntheta:]
+        if post:
+            rbdry, zbdry = k2rz_post(self.x, rbdry, zbdry, self.closed_surface, self.xpt_correction)
+        return rbdry, zbdry
+
+    def predict_members(self, post=True):
+        self.ys = self.model.predict([self.x], self.nmodels)[:, 0]
+        return k2rz_post_members(self.x, self.ys, self.ntheta, post, self.closed_surface, self.xpt_correction)
+
+    def predict_batch(self, xs, post=True):
+        # Ensemble-mean boundaries for (B, 8) inputs from one batched evaluation
+        ys = np.mean(self.model.predict(xs, self.nmodels), axis=0, dtype=float)
+        return k2rz_post_batch(xs, ys, self.ntheta, post, self.closed_surface, self.xpt_correction)
+
+class np_tf_dense_model():
+    def __init__(self, model_path, n_models=1, ymean=0, ystd=1, precision='float32'):
+        self.nmodels = n_models
+        self.ymean, self.ystd = ymean, ystd
+        self.model = np_dense_model(*load_dense_weights(model_path, n_models), precision)
+
+    def set_inputs(self, x):
+        self.x = np.array(x) if len(np.shape(x)) == 2 else np.array([x])
+
+    def predict_ensemble(self, x, per_member=False):
+        if per_member:
+            self.x = np.array(x)
+        else:
+            self.set_inputs(x)
+        return self.model.predict(self.x, self.nmodels, per_member) * self.ystd + self.ymean
+
+    def predict_members(self, x):
+        self.ys = self.predict_ensemble(x)[:, 0]
+        return self.ys
+
+    def predict(self, x):
+        self.y = np.mean(self.predict_members(x), axis=0)
+        return self.y
+
+class np_kstar_nn(np_tf_dense_model):
+    def __init__(self, model_path, n_models=1, ymean=None, ystd=None, precision='float32'):
+        if ymean is None:
+            ymean = [1.22379703, 5.2361062,  1.64438005, 1.12040048]
+            ystd  = [0.72255576, 1.5622809,  0.96563557, 0.23868018]
+        super().__init__(model_path, n_models, ymean, ystd, precision)
+
+class np_bpw_nn(np_tf_dense_model):
+    def __init__(self, model_path, n_models=1, precision='float32'):
+        super().__init__(model_path, n_models, np.array([1.02158800e+00, 1.87408512e+05]), np.array([6.43390272e-01, 1.22543529e+05]), precision)
+
+class np_kstar_lstm():
+    def __init__(self, model_path, n_models=1, ymean=None, ystd=None, precision='float32'):
+        self.nmodels = n_models
+        if ymean is None:
+            self.ymean = [1.30934765, 5.20082444, 1.47538417, 1.14439883]
+            self.ystd  = [0.74135689, 1.44731883, 0.56747578, 0.23018484]
+        else:
+            self.ymean, self.ystd = ymean, ystd
+        self.model = np_custom_model(load_custom_weights(model_path, n_models, [200, 200], [200, 4]), [200, 200], [200, 4], precision)
+
+    def set_inputs(self, x):
+        self.x = np.array(x) if len(np.shape(x)) == 3 else np.array([x])
+
+    def predict_ensemble(self, x=None, per_member=False):
+        if per_member:
+            self.x = np.array(x)
+        elif type(x) == type(np.zeros(1)):
+            self.set_inputs(x)
+        return self.model.predict(self.x, self.nmodels, per_member) * self.ystd + self.ymean
+
+    def predict_members(self, x=None):
+        self.ys = self.predict_ensemble(x)[:, 0]
+        return self.ys
+
+    def predict(self, x=None):
+        self.y = np.mean(self.predict_members(x), axis=0)
+        return self.y
+
+class np_kstar_v220505():
+    def __init__(self, model_path, n_models=1, ymean=None, ystd=None, length=10, precision='float32'):
+        if ymean is None or ystd is None:
+            self.ymean = [1.4361666, 5.275876, 1.534538, 1.1268075]
+            self.ystd = [0.7294007, 1.5010427, 0.6472052, 0.2331879]
+        else:
+            self.ymean, self.ystd = ymean, ystd
+        self.nmodels, self.length = n_models, length
+        self.model = np_custom_model(load_custom_weights(model_path, n_models, [100, 100], [50, 4]), [100, 100], [50, 4], precision)
+
+    def set_inputs(self, x):
+        self.x = np.array(x) if len(np.shape(x)) == 3 else np.array([x])
+
+    def predict_ensemble(self, x=None, per_member=False):
+        if per_member:
+            self.x = np.array(x)
+        elif type(x) == type(np.zeros(1)):
+            self.set_inputs(x)
+        return self.model.predict(self.x, self.nmodels, per_member) * self.ystd + self.ymean
+
+    def predict_members(self, x=None):
+        self.ys = self.predict_ensemble(x)[:, 0]
+        return self.ys
+
+    def predict(self, x=None):
+        self.y = np.mean(self.predict_members(x), axis=0)
+        return self.y
@@ -0,0 +1,85 @@
+import time, json, argparse
+import numpy as np
+from common.simulator import BatchKSTARSimulator, input_params, input_mins, input_maxs, input_init, output_params2
+
+# Accuracy of the reduced-precision NumPy engines (float16 / int8 kernels) against float32
+# on a fixed reference set of discharges: constant settings across the actuator box and
+# ramps between them, rolled out with the full ensemble, plus the k2rz boundaries. Sizes are the
+# resident weight memory of each engine, including the scratch buffer reduced kernels are expanded
+# into; the step latency of each mode is timed on a second rollout.
+
+def reference_waveforms(n_scenarios=32, steps=40, seed=0):
+    # (steps, S, 15): the first half holds random settings (the first is input_init), the second ramps to new ones
+    rng = np.random.default_rng(seed)
+    start = rng.uniform(input_mins, input_maxs, (n_scenarios, len(input_params)))
+    start[0] = input_init
+    end = rng.uniform(input_mins, input_maxs, (n_scenarios, len(input_params)))
+    ramp = np.clip(np.linspace(0, 1, steps - steps // 2), 0, 1)[:, None, None]
+    return np.concatenate([np.broadcast_to(start, (steps // 2,) + start.shape), start + ramp * (end - start)])
+
+def model_bytes(sim):
+    return {'kstar_nn': sim.kstar_nn.model.nbytes(), 'lstm': sim.kstar_lstm.model.nbytes(),
+            'bpw': sim.bpw_nn.model.nbytes(), 'k2rz': sim.k2rz.model.nbytes()}
+
+def run_reference(precision, waveforms, n_models=10, **kwargs):
+    sim = BatchKSTARSimulator(waveforms.shape[1], backend='numpy', precision=precision, n_models=n_models, max_models=n_models,
+                              n_shape_models=n_models, **kwargs)
+    sim.rollout(waveforms)
+    sim.reset()
+    start = time.perf_counter()
+    ys = sim.rollout(waveforms)
+    step_ms = 1.e3 * (time.perf_counter() - start) / len(waveforms)
+    # Boundaries as drawn and the network output alone: the X-point correction moves the point at the
+    # lowest (or highest) z, so an error that changes which point that is moves it by a point spacing
+    boundary = np.stack(sim.predict_boundaries(waveforms[-1]))
+    sim.k2rz.xpt_correction = False
+    return sim, ys, (boundary, np.stack(sim.predict_boundaries(waveforms[-1]))), step_ms
+
+def precision_report(precisions=['float16', 'int8'], n_scenarios=32, steps=40, n_models=10, seed=0, **kwargs):
+    waveforms = reference_waveforms(n_scenarios, steps, seed)
+    sim, ys, boundary, step_ms = run_reference('float32', waveforms, n_models, **kwargs)
+    scale = np.maximum(np.std(ys, axis=(0, 1)), 1.e-12)
+    report = {'reference': {'n_scenarios': n_scenarios, 'steps': steps, 'n_models': n_models, 'seed': seed},
+              'float32': {'bytes': model_bytes(sim), 'step_ms': step_ms}}
+    for precision in precisions:
+        sim, ys_reduced, boundary_reduced, step_ms = run_reference(precision, waveforms, n_models, **kwargs)
+        error = np.abs(ys_reduced - ys)
+        report[precision] = {
+            'bytes': model_bytes(sim),
+            'step_ms': step_ms,
+            'outputs': {p: {'max': float(np.max(error[..., i])), 'mean': float(np.mean(error[..., i])),
+                            'max_normalized': float(np.max(error[..., i]) / scale[i])} for i, p in enumerate(output_params2)},
+            'final_step_max_normalized': float(np.max(error[-1] / scale)),
+            'boundary_max_m': float(np.max(np.abs(boundary_reduced[0] - boundary[0]))),
+            'boundary_network_max_m': float(np.max(np.abs(boundary_reduced[1] - boundary[1]))),
+        }
+    return report
+
+def print_report(report):
+    full, full_ms = sum(report['float32']['bytes'].values()), report['float32']['step_ms']
+    print(f'float32: weights {full / 1.e6:.2f} MB, step {full_ms:.3f} ms')
+    for precision, result in report.items():
+        if precision in ['reference', 'float32']:
+            continue
+        size = sum(result['bytes'].values())
+        print(f'{precision}: weights {size / 1.e6:.2f} MB ({size / full:.2f} of float32), '
+              f"step {result['step_ms']:.3f} ms ({result['step_ms'] / full_ms:.2f} of float32), boundary max error {1.e3 * result['boundary_max_m']:.3f} mm "
+              f"({1.e3 * result['boundary_network_max_m']:.3f} mm without the X-point correction)")
+        for p, e in result['outputs'].items():
+            print(f"  {p:6s} max {e['max']:.3e}  mean {e['mean']:.3e}  max/std {e['max_normalized']:.3e}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Accuracy of reduced-precision weights against float32')
+    parser.add_argument('--precisions', nargs='+', default=['float16', 'int8'], choices=['float16', 'int8'])
+    parser.add_argument('--n-scenarios', type=int, default=32)
+    parser.add_argument('--steps', type=int, default=40)
+    parser.add_argument('--n-models', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None, help='optional JSON file for the full report')
+    args = parser.parse_args()
+
+    report = precision_report(args.precisions, args.n_scenarios, args.steps, args.n_models, args.seed)
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,85 @@
+import os, time, json, threading
+from collections import deque
+import numpy as np
+
+# Per-stage timing of the stepping loop and the GUI. Stages are timed with
+#     with profiler.stage('lstm'):
+#         ...
+# which returns a shared no-op context when profiling is off. Counts and means cover every call,
+# percentiles the latest `samples` calls; with trace=True the calls are also kept as Chrome trace
+# events (chrome://tracing, Perfetto). KSTAR_PROFILE=1 (or =trace) enables it from the environment.
+
+class null_stage():
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+class timed_stage():
+    def __init__(self, profiler, name):
+        self.profiler, self.name = profiler, name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.profiler.record(self.name, self.start, time.perf_counter())
+        return False
+
+class stage_profiler():
+    def __init__(self, enabled=False, trace=False, samples=4096, trace_events=100000):
+        self.enabled, self.trace = enabled, trace
+        self.samples, self.trace_events = samples, trace_events
+        self.lock = threading.Lock()
+        self.origin = time.perf_counter()
+        self.null = null_stage()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counts, self.totals, self.durations = {}, {}, {}
+            self.events = deque(maxlen=self.trace_events)
+
+    def stage(self, name):
+        return timed_stage(self, name) if self.enabled else self.null
+
+    def record(self, name, start, end):
+        with self.lock:
+            if name not in self.counts:
+                self.counts[name], self.totals[name], self.durations[name] = 0, 0., deque(maxlen=self.samples)
+            self.counts[name] += 1
+            self.totals[name] += end - start
+            self.durations[name].append(end - start)
+            if self.trace:
+                self.events.append((name, threading.get_ident(), start, end))
+
+    def summary(self):
+        # Per-stage call count, mean and tail latencies in milliseconds
+        with self.lock:
+            stats = {}
+            for name, count in self.counts.items():
+                ts = 1.e3 * np.array(self.durations[name])
+                p50, p95, p99 = np.percentile(ts, [50, 95, 99])
+                stats[name] = {'count': count, 'mean_ms': 1.e3 * self.totals[name] / count,
+                               'p50_ms': p50, 'p95_ms': p95, 'p99_ms': p99, 'max_ms': np.max(ts)}
+        return stats
+
+    def report(self):
+        lines = [f"{'stage':20s} {'count':>8s} {'mean':>9s} {'p50':>9s} {'p95':>9s} {'p99':>9s} {'max':>9s} [ms]"]
+        for name, s in sorted(self.summary().items(), key=lambda item: -item[1]['mean_ms'] * item[1]['count']):
+            lines.append(f"{name:20s} {s['count']:8d} {s['mean_ms']:9.3f} {s['p50_ms']:9.3f} {s['p95_ms']:9.3f} {s['p99_ms']:9.3f} {s['max_ms']:9.3f}")
+        return '\n'.join(lines)
+
+    def export_trace(self, path):
+        # Chrome trace event format, complete ('X') events in microseconds
+        with self.lock:
+            events = [{'name': name, 'ph': 'X', 'pid': os.getpid(), 'tid': tid,
+                       'ts': 1.e6 * (start - self.origin), 'dur': 1.e6 * (end - start)} for name, tid, start, end in self.events]
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+        return path
+
+profile_mode = os.environ.get('KSTAR_PROFILE', '0').lower()
+profiler = stage_profiler(enabled=profile_mode not in ['', '0', 'false'], trace=profile_mode == 'trace')
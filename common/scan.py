@@ -0,0 +1,83 @@
+import os, argparse, itertools
+import multiprocessing as mp
+import numpy as np
+from common.simulator import BatchKSTARSimulator, input_params, input_init, output_params2
+
+# Parameter scan over the 15 actuator inputs, sharded over a process pool.
+# Every worker loads the ensemble once and relaxes (or rolls out) its shard as one batch.
+
+thread_variables = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']
+worker_simulator = None
+
+def make_grid(axes, base=input_init):
+    # axes: {input_param: values}, the other inputs are held at base
+    names = list(axes.keys())
+    points = np.tile(np.array(base, dtype=float), (int(np.prod([len(axes[n]) for n in names])), 1))
+    for i, values in enumerate(itertools.product(*[axes[n] for n in names])):
+        for name, value in zip(names, values):
+            points[i, input_params.index(name)] = value
+    return points
+
+def init_worker(kwargs):
+    global worker_simulator
+    worker_simulator = BatchKSTARSimulator(1, **kwargs)
+
+def run_shard(args):
+    points, steps, history = args
+    sim = worker_simulator
+    sim.n_scenarios = len(points)
+    sim.reset()
+    if points.ndim == 3:
+        ys = sim.rollout(np.swapaxes(points, 0, 1))
+    else:
+        ys = np.array([sim.step(points) for i in range(steps)])
+    return np.swapaxes(ys, 0, 1) if history else ys[-1]
+
+def run_scan(points, steps=20, history=False, processes=None, shard_size=256, threads_per_worker=1, **kwargs):
+    # points: (P, 15) held constant for `steps` steps, or (P, T, 15) waveforms
+    # Returns (P, 8), or (P, T, 8) with history=True, in output_params2 order
+    points = np.asarray(points, dtype=float)
+    kwargs.setdefault('backend', 'numpy')
+    processes = processes or os.cpu_count()
+    shard_size = max(1, min(shard_size, int(np.ceil(len(points) / processes))))
+    shards = [(points[i:i + shard_size], steps, history) for i in range(0, len(points), shard_size)]
+
+    environ = {v: os.environ.get(v) for v in thread_variables}
+    os.environ.update({v: str(threads_per_worker) for v in thread_variables})
+    try:
+        with mp.get_context('spawn').Pool(processes, initializer=init_worker, initargs=(kwargs,)) as pool:
+            results = pool.map(run_shard, shards)
+    finally:
+        for v, value in environ.items():
+            if value is None:
+                os.environ.pop(v)
+            else:
+                os.environ[v] = value
+    return np.concatenate(results)
+
+def parse_axis(text):
+    # 'Ip [MA]=0.3:0.8:6' (linspace) or 'Ip [MA]=0.4,0.5,0.6'
+    name, values = text.split('=')
+    if ':' in values:
+        start, stop, num = values.split(':')
+        return name, np.linspace(float(start), float(stop), int(num))
+    return name, np.array([float(v) for v in values.split(',')])
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='KSTAR-NN parameter scan')
+    parser.add_argument('--grid', action='append', default=[], help="e.g. --grid 'Ip [MA]=0.3:0.8:6'")
+    parser.add_argument('--points', help='.npy file with (P, 15) or (P, T, 15) actuator settings')
+    parser.add_argument('--steps', type=int, default=20)
+    parser.add_argument('--n-models', type=int, default=1)
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--shard-size', type=int, default=256)
+    parser.add_argument('--backend', default='numpy')
+    parser.add_argument('--history', action='store_true')
+    parser.add_argument('--output', default='scan.npz')
+    args = parser.parse_args()
+
+    points = np.load(args.points) if args.points else make_grid(dict(parse_axis(a) for a in args.grid))
+    ys = run_scan(points, steps=args.steps, history=args.history, processes=args.processes, shard_size=args.shard_size,
+                  n_models=args.n_models, max_models=args.n_models, backend=args.backend)
+    np.savez(args.output, points=points, outputs=ys, output_params=np.array(output_params2))
+    print(f'{len(points)} points -> {args.output}')
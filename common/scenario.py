@@ -0,0 +1,94 @@
+import csv, argparse
+import numpy as np
+from common.simulator import KSTARSimulator, input_params, input_init, output_params2
+
+# Drive the simulator from a prescribed discharge program.
+# The program is a table of knots (time [s] and any of the input_params columns); missing
+# actuators are held at input_init and values are linearly interpolated onto the 0.1 s LSTM step.
+# Knots, steps and output rows are all generators, so memory does not grow with program length.
+
+step_time = 0.1
+time_column = 'time'
+
+def read_csv_knots(path, base=input_init):
+    with open(path, newline='') as f:
+        reader = csv.DictReader(f)
+        columns = [c for c in reader.fieldnames if c != time_column]
+        unknown = [c for c in columns if c not in input_params]
+        if time_column not in reader.fieldnames or unknown:
+            raise ValueError(f"{path} needs a '{time_column}' column and input_params columns, got unknown {unknown}")
+        index = [input_params.index(c) for c in columns]
+        for row in reader:
+            u = np.array(base, dtype=float)
+            u[index] = [float(row[c]) for c in columns]
+            yield float(row[time_column]), u
+
+def read_npz_knots(path, base=input_init):
+    # 'time' (T,) with either 'actuators' (T, 15) or one (T,) array per input_params name
+    data = np.load(path)
+    ts = data[time_column]
+    if 'actuators' in data.files:
+        us = data['actuators']
+    else:
+        unknown = [c for c in data.files if c not in input_params + [time_column]]
+        if unknown:
+            raise ValueError(f'{path} has unknown arrays {unknown}')
+        us = np.tile(np.array(base, dtype=float), (len(ts), 1))
+        for c in data.files:
+            if c != time_column:
+                us[:, input_params.index(c)] = data[c]
+    for t, u in zip(ts, us):
+        yield float(t), np.array(u, dtype=float)
+
+def read_knots(path, base=input_init):
+    if path.endswith('.npz'):
+        return read_npz_knots(path, base)
+    return read_csv_knots(path, base)
+
+def resample(knots, dt=step_time):
+    # Linear interpolation of (t, u) knots onto t0 + k * dt up to the last knot
+    knots = iter(knots)
+    t0, u0 = next(knots)
+    start, k = t0, 0
+    for t1, u1 in knots:
+        if t1 <= t0:
+            raise ValueError(f'Waveform times must increase, got {t1} after {t0}')
+        while start + k * dt <= t1 + 1.e-9:
+            t = start + k * dt
+            yield t, u0 + (u1 - u0) * (t - t0) / (t1 - t0)
+            k += 1
+        t0, u0 = t1, u1
+    if k == 0:
+        yield t0, u0
+
+def run_scenario(sim, knots, dt=step_time):
+    # Yields (time, actuators, outputs in output_params2 order) per step of a fresh discharge
+    sim.reset()
+    for t, u in resample(knots, dt):
+        yield t, u, sim.step(u)
+
+def write_rows(rows, output_path, flush_every=100):
+    # Streams (time, actuators, outputs) rows to a CSV file; returns the number of rows written
+    n = 0
+    with open(output_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow([time_column] + input_params + output_params2)
+        for t, u, y in rows:
+            writer.writerow([f'{t:.4f}'] + [f'{v:.6g}' for v in u] + [f'{v:.6g}' for v in y])
+            n += 1
+            if n % flush_every == 0:
+                f.flush()
+    return n
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run KSTAR-NN on a prescribed actuator program')
+    parser.add_argument('program', help=f"CSV or NPZ with a '{time_column}' column/array and input_params columns")
+    parser.add_argument('--output', default='scenario_outputs.csv')
+    parser.add_argument('--n-models', type=int, default=1)
+    parser.add_argument('--backend', default='numpy')
+    parser.add_argument('--weights-archive', default=None)
+    args = parser.parse_args()
+
+    sim = KSTARSimulator(n_models=args.n_models, max_models=args.n_models, backend=args.backend, weights_archive=args.weights_archive)
+    n = write_rows(run_scenario(sim, read_knots(args.program)), args.output)
+    print(f'{n} steps -> {args.output}')
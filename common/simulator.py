@@ -0,0 +1,448 @@
+import os
+from collections import OrderedDict
+import numpy as np
+from common.numpy_models import ensemble_bands
+from common.profiler import profiler
+
+# Setting
+base_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+lstm_model_path = base_path + '/weights/lstm/v220505/'
+nn_model_path = base_path + '/weights/nn/'
+bpw_model_path = base_path + '/weights/bpw/v220505/'
+k2rz_model_path = base_path + '/weights/k2rz/'
+bpw_ymean = [1.3630552066021155, 251779.19861710534]
+bpw_ystd = [0.6252123013157276, 123097.77805034176]
+history_length = 40
+year_in = 2021
+cache_size = 256
+# Boundary cache bin of betap, a model output: within a bin the k2rz boundary moves by ~0.04 mm
+# (median) but can jump by several cm where the X-point correction switches
+betap_resolution = 1.e-3
+
+# Inputs
+input_params = ['Ip [MA]','Bt [T]','GW.frac. [-]',\
+                'Pnb1a [MW]','Pnb1b [MW]','Pnb1c [MW]',\
+                'Pec2 [MW]','Pec3 [MW]','Zec2 [cm]','Zec3 [cm]',\
+                'In.Mid. [m]','Out.Mid. [m]','Elon. [-]','Up.Tri. [-]','Lo.Tri [-]']
+input_mins = [0.3,1.5,0.2, 0.0, 0.0, 0.0, 0.0,0.0,-10,-10, 1.265,2.18,1.6,0.1,0.5 ]
+input_maxs = [0.8,2.7,0.6, 1.75,1.75,1.5, 0.8,0.8, 10, 10, 1.36, 2.29,2.0,0.5,0.9 ]
+input_init = [0.5,1.8,0.4, 1.5, 0.0, 0.0, 0.0,0.0,0.0,0.0, 1.34, 2.22,1.7,0.3,0.75]
+
+# Outputs
+output_params0 = ['betan','q95','q0','li']
+output_params1 = ['betap','wmhd']
+output_params2 = ['betan','betap','h89','h98','q95','q0','li','wmhd']
+
+# Model inputs are linear in the actuators apart from the wall-limited flag, so each feature set is
+# one (15, n) gather matrix with the (rin, rout) -> (rgeo, amin) transform folded in, a constant
+# row and the flag column filled from In.Mid. afterwards
+limited_rin = 1.265 + 1.e-4
+
+def gather_matrix(index, n_features, geometry=None):
+    m = np.zeros([len(input_params), n_features])
+    m[index, np.arange(len(index))] = 1
+    if geometry is not None:
+        i, j = geometry
+        m[:, i], m[:, j] = 0.5*(m[:, i]+m[:, j]), 0.5*(m[:, j]-m[:, i])
+    return m
+
+# kstar_nn (17): Ip, Bt, Pnb1a-c, Pec2-3, Zec2-3, rgeo, amin, k, du, dl, limited flag, GW.frac., year
+nn_matrix = gather_matrix([0,1,3,4,5,6,7,8,9,10,11,12,13,14,10,2], 17, geometry=(9, 10))
+nn_matrix[:, 14] = 0
+nn_bias = np.zeros(17)
+nn_bias[16] = year_in
+
+# v220505 LSTM actuator columns (14): Ip, Bt, GW.frac., k, du, dl, rin, rout, Pnb1a-c, Pec2+Pec3, limited flag, year
+lstm_matrix = gather_matrix([0,1,2,12,13,14,10,11,3,4,5,6,10], 14)
+lstm_matrix[7, 11] = 1
+lstm_matrix[:, 12] = 0
+lstm_bias = np.zeros(14)
+lstm_bias[13] = year_in
+
+# bpw (8): betan, Ip, Bt, rgeo, amin, k, du, dl; betan is added separately
+bpw_matrix = gather_matrix([0,0,1,10,11,12,13,14], 8, geometry=(3, 4))
+bpw_matrix[:, 0] = 0
+bpw_betan = np.eye(8)[0]
+
+def nn_features(u):
+    # kstar_nn input (..., 17) from actuators (..., 15)
+    x = np.matmul(u, nn_matrix) + nn_bias
+    x[..., 14] = u[..., 10] > limited_rin
+    return x
+
+def lstm_features(u):
+    # Actuator columns of the v220505 LSTM input (x[..., 4:]) from actuators (..., 15)
+    x = np.matmul(u, lstm_matrix) + lstm_bias
+    x[..., 12] = u[..., 10] > limited_rin
+    return x
+
+def bpw_features(u, betan):
+    # bpw input (..., 8) from actuators (..., 15) and the latest betan (...)
+    return np.matmul(u, bpw_matrix) + np.multiply.outer(betan, bpw_betan)
+
+def h_factors(u, wmhd):
+    ip, bt, fgw = u[..., 0], u[..., 1], u[..., 2]
+    ptot = np.maximum(u[..., 3] + u[..., 4] + u[..., 5] + u[..., 6] + u[..., 7], 1.e-1) # Not to diverge
+    rin, rout, k = u[..., 10], u[..., 11], u[..., 12]
+
+    rgeo,amin = 0.5*(rin+rout),0.5*(rout-rin)
+    ne = fgw*10*(ip/(np.pi*amin**2))
+    m = 2.0 # Mass number
+
+    tau89 = 0.038*ip**0.85*bt**0.2*ne**0.1*ptot**-0.5*rgeo**1.5*k**0.5*(amin/rgeo)**0.3*m**0.5
+    tau98 = 0.0562*ip**0.93*bt**0.15*ne**0.41*ptot**-0.69*rgeo**1.97*k**0.78*(amin/rgeo)**0.58*m**0.19
+    h89 = 1.e-6*wmhd/ptot/tau89
+    h98 = 1.e-6*wmhd/ptot/tau98
+    return h89, h98
+
+def cache_key(*values):
+    # Exact actuators: slider values are already discrete, and rounding could merge inputs on
+    # opposite sides of a threshold such as limited_rin
+    return b''.join(np.asarray(v, dtype=np.float64).tobytes() for v in values)
+
+class LRUCache():
+    # Bounded least-recently-used cache with hit/miss counters; maxsize=0 disables it
+    def __init__(self, maxsize=cache_size):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.hits, self.misses = 0, 0
+
+    def get(self, key, compute):
+        if key in self.data:
+            self.data.move_to_end(key)
+            self.hits += 1
+            return self.data[key]
+        self.misses += 1
+        value = compute()
+        if self.maxsize > 0:
+            self.data[key] = value
+            if len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+        return value
+
+    def clear(self):
+        self.data.clear()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.data), 'maxsize': self.maxsize}
+
+class RingBuffer():
+    # Fixed-size history of the last `capacity` entries. Every entry is written twice, so the
+    # ordered contents are always one contiguous slice and view() never copies.
+    def __init__(self, capacity, shape=(), count=0, dtype=float):
+        self.capacity, self.count, self.start = capacity, count, 0
+        self.data = np.zeros((2 * capacity,) + tuple(shape), dtype=dtype)
+
+    def append(self, value):
+        end = (self.start + self.count) % self.capacity
+        self.data[end] = self.data[end + self.capacity] = value
+        if self.count < self.capacity:
+            self.count += 1
+        else:
+            self.start = (self.start + 1) % self.capacity
+
+    def fill(self, value):
+        self.data[...] = value
+
+    def view(self):
+        # Oldest to newest; the view is overwritten by later appends
+        return self.data[self.start:self.start + self.count]
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        return self.view()[i]
+
+    def __iter__(self):
+        return iter(self.view())
+
+    def __array__(self, dtype=None, copy=None):
+        return self.view() if dtype is None else self.view().astype(dtype)
+
+class KSTARState():
+    def __init__(self, length=10, history_length=history_length):
+        self.length, self.history_length = length, history_length
+        self.first = True
+        # Row i of the LSTM window holds the outputs of step i - 1 next to the actuators of step i,
+        # so a step appends one row instead of shifting the whole window
+        self.window = RingBuffer(length, (18,), count=length)
+        self.row = np.zeros(18)
+        self.y = np.zeros(len(output_params0))
+        self.outputs = {}
+        for p in output_params2:
+            self.outputs[p] = RingBuffer(history_length, count=1)
+        self.rbdry, self.zbdry = None, None
+
+    @property
+    def x(self):
+        return self.window.view()
+
+    def append(self, params, y):
+        for p, value in zip(params, y):
+            if len(self.outputs[p]) == 1:
+                self.outputs[p].fill(value)
+            self.outputs[p].append(value)
+
+    def latest(self):
+        return np.array([self.outputs[p][-1] for p in output_params2])
+
+class KSTARSimulator():
+    def __init__(self, n_models=1, max_models=10, n_shape_models=1, length=10, history_length=history_length, fused=True,
+                 backend='keras', prefetch=False, weights_archive=None, boundary_table=None, precision='float32', cache_size=cache_size, betap_resolution=betap_resolution,
+                 nn_model_path=nn_model_path, lstm_model_path=lstm_model_path, bpw_model_path=bpw_model_path, k2rz_model_path=k2rz_model_path):
+        # Keras members beyond n_models are loaded when set_model_number() asks for them,
+        # or in a background thread with prefetch=True
+        self.length, self.history_length = length, history_length
+        # Boundary and steady-state predictions are cached on the exact actuators; the boundary key
+        # also holds betap binned to betap_resolution
+        self.betap_resolution = betap_resolution
+        self.boundary_cache, self.steady_cache = LRUCache(cache_size), LRUCache(cache_size)
+        self.backend = backend
+        if backend != 'numpy' and precision != 'float32':
+            raise ValueError(f"precision='{precision}' needs backend='numpy'")
+        if backend == 'keras':
+            from common.model_structure import k2rz, kstar_nn, kstar_v220505, tf_dense_model
+            self.kstar_nn = kstar_nn(model_path=nn_model_path, n_models=1)
+            self.kstar_lstm = kstar_v220505(model_path=lstm_model_path, n_models=n_models, length=length, fused=fused, max_models=max_models)
+            self.k2rz = k2rz(model_path=k2rz_model_path, n_models=n_shape_models)
+            self.bpw_nn = tf_dense_model(model_path=bpw_model_path, n_models=n_models, ymean=bpw_ymean, ystd=bpw_ystd, fused=fused, max_models=max_models)
+            if prefetch:
+                self.kstar_lstm.prefetch()
+                self.bpw_nn.prefetch()
+        elif backend == 'numpy':
+            from common.numpy_models import np_k2rz, np_kstar_nn, np_kstar_v220505, np_tf_dense_model
+            if weights_archive is not None:
+                # Memory-mapped weights shared between processes (see common/weight_archive.py)
+                from common.weight_archive import weight_archive
+                archive = weight_archive(weights_archive)
+                nn_model_path, lstm_model_path, bpw_model_path, k2rz_model_path = archive['nn'], archive['lstm'], archive['bpw'], archive['k2rz']
+            # Reduced precision only changes the stored kernels (see reduce_precision)
+            self.kstar_nn = np_kstar_nn(model_path=nn_model_path, n_models=1, precision=precision)
+            self.kstar_lstm = np_kstar_v220505(model_path=lstm_model_path, n_models=max_models, length=length, precision=precision)
+            self.k2rz = np_k2rz(model_path=k2rz_model_path, n_models=n_shape_models, precision=precision)
+            self.bpw_nn = np_tf_dense_model(model_path=bpw_model_path, n_models=max_models, ymean=bpw_ymean, ystd=bpw_ystd, precision=precision)
+        else:
+            raise ValueError(f'Unknown backend: {backend}')
+        if boundary_table is not None:
+            # Interpolated boundaries from a precomputed table (see common/boundary_table.py)
+            from common.boundary_table import table_k2rz
+            self.k2rz = table_k2rz(boundary_table)
+        self.set_model_number(n_models)
+        self.reset()
+
+    def set_model_number(self, n_models):
+        if self.backend == 'keras':
+            self.kstar_lstm.load_models(n_models)
+            self.bpw_nn.load_models(n_models)
+        self.kstar_lstm.nmodels = n_models
+        self.bpw_nn.nmodels = n_models
+
+    def reset(self):
+        self.state = KSTARState(self.length, self.history_length)
+        return self.state
+
+    def cache_stats(self):
+        return {'boundary': self.boundary_cache.stats(), 'steady': self.steady_cache.stats()}
+
+    def shuffle_models(self):
+        self.boundary_cache.clear()
+        self.steady_cache.clear()
+        for m in [self.k2rz, self.kstar_lstm, self.bpw_nn]:
+            if hasattr(m, 'shuffle'):
+                m.shuffle()
+            elif self.backend == 'numpy':
+                m.model.shuffle()
+            else:
+                np.random.shuffle(m.models)
+
+    def predict_boundary(self, actuators):
+        u = np.asarray(actuators, dtype=float)
+        # k2rz sees betap snapped to its bin, so a cached boundary does not depend on which step filled it
+        betap = self.betap_resolution * np.rint(self.state.outputs['betap'][-1] / self.betap_resolution)
+        key = cache_key(u[[0, 1, 10, 11, 12, 13, 14]], betap, self.k2rz.nmodels)
+
+        def predict():
+            self.k2rz.set_inputs(u[0], u[1], betap, u[10], u[11], u[12], u[13], u[14])
+            return self.k2rz.predict(post=True)
+
+        with profiler.stage('boundary'):
+            rbdry, zbdry = self.boundary_cache.get(key, predict)
+        self.state.rbdry, self.state.zbdry = rbdry.copy(), zbdry.copy()
+        return self.state.rbdry, self.state.zbdry
+
+    def predict_boundary_members(self, actuators):
+        # Per-member boundaries (M, ntheta + 1) from one batched k2rz evaluation
+        u = np.asarray(actuators, dtype=float)
+        self.k2rz.set_inputs(u[0], u[1], self.state.outputs['betap'][-1], u[10], u[11], u[12], u[13], u[14])
+        return self.k2rz.predict_members(post=True)
+
+    def predict_steady(self, u):
+        y = self.steady_cache.get(cache_key(u, self.kstar_nn.nmodels), lambda: self.kstar_nn.predict(nn_features(u)))
+        self.state.row[:len(output_params0)] = self.state.y = y
+        self.state.row[len(output_params0):] = lstm_features(u)
+        self.state.window.fill(self.state.row)
+        return y
+
+    def predict_lstm(self, u):
+        self.state.row[:len(output_params0)] = self.state.y
+        self.state.row[len(output_params0):] = lstm_features(u)
+        self.state.window.append(self.state.row)
+        self.state.y = self.kstar_lstm.predict(self.state.window.view())
+        return self.state.y
+
+    def predict_bpw(self, u):
+        return self.bpw_nn.predict(bpw_features(u, self.state.outputs['betan'][-1]))
+
+    def step(self, actuators, steady=None, boundary=False):
+        u = np.asarray(actuators, dtype=float)
+        if steady is None:
+            steady = self.state.first
+
+        # Predict output_params0 (betan, q95, q0, li)
+        with profiler.stage('steady' if steady else 'lstm'):
+            y = self.predict_steady(u) if steady else self.predict_lstm(u)
+            self.state.append(output_params0, y)
+
+        # Predict output_params1 (betap, wmhd)
+        with profiler.stage('bpw'):
+            y = self.predict_bpw(u)
+            self.state.append(output_params1, y)
+
+        # Estimate H factors (h89, h98)
+        with profiler.stage('h_factors'):
+            self.state.append(['h89', 'h98'], h_factors(u, self.state.outputs['wmhd'][-1]))
+
+        if boundary:
+            self.predict_boundary(u)
+        self.state.first = False
+        return self.state.latest()
+
+    def relax(self, actuators, steps):
+        for i in range(steps):
+            y = self.step(actuators)
+        return y
+
+    def rollout(self, waveforms, boundary=False):
+        waveforms = np.atleast_2d(waveforms)
+        ys = np.zeros([len(waveforms), len(output_params2)])
+        rbdrys, zbdrys = [], []
+        for i, u in enumerate(waveforms):
+            ys[i] = self.step(u, boundary=boundary)
+            if boundary:
+                rbdrys.append(self.state.rbdry)
+                zbdrys.append(self.state.zbdry)
+        if boundary:
+            return ys, np.array(rbdrys), np.array(zbdrys)
+        return ys
+
+class KSTARBatchState():
+    # With n_members the window and outputs carry a leading member axis, (M, N, length, 18) and (M, N, 8)
+    def __init__(self, n_scenarios, length=10, n_members=None):
+        self.n_scenarios, self.length, self.n_members = n_scenarios, length, n_members
+        shape = (n_scenarios,) if n_members is None else (n_members, n_scenarios)
+        self.first = np.ones(n_scenarios, dtype=bool)
+        self.x = np.zeros(shape + (length, 18))
+        self.y = np.zeros(shape + (len(output_params2),))
+
+    def reset(self, mask=None):
+        mask = slice(None) if mask is None else mask
+        self.first[mask] = True
+        self.x[..., mask, :, :] = 0.
+        self.y[..., mask, :] = 0.
+
+class BatchKSTARSimulator(KSTARSimulator):
+    # Advances N independent discharges in lockstep; outputs are (N, 8) in output_params2 order.
+    # With members=True every LSTM/bpw member is rolled out on its own autoregressive window,
+    # so the ensemble spread propagates in time (see bands()).
+    def __init__(self, n_scenarios, members=False, **kwargs):
+        self.n_scenarios, self.members = n_scenarios, members
+        super().__init__(**kwargs)
+
+    def reset(self, mask=None):
+        if mask is None or not hasattr(self, 'state'):
+            n_members = self.kstar_lstm.nmodels if self.members else None
+            self.state = KSTARBatchState(self.n_scenarios, self.length, n_members)
+        else:
+            self.state.reset(mask)
+        return self.state
+
+    def predict_steady(self, u, idx):
+        y = np.mean(self.kstar_nn.predict_ensemble(nn_features(u)), axis=0)
+        self.state.x[..., idx, :, :len(output_params0)] = y[:, None]
+        self.state.x[..., idx, :, len(output_params0):] = lstm_features(u)[:, None]
+        return y
+
+    def predict_lstm(self, u, idx):
+        x = self.state.x[..., idx, :, :]
+        x[..., :-1, len(output_params0):] = x[..., 1:, len(output_params0):]
+        x[..., -1, len(output_params0):] = lstm_features(u)
+        y = self.kstar_lstm.predict_ensemble(x, per_member=self.members)
+        y = y if self.members else np.mean(y, axis=0)
+        x[..., :-1, :len(output_params0)] = x[..., 1:, :len(output_params0)]
+        x[..., -1, :len(output_params0)] = y
+        self.state.x[..., idx, :, :] = x
+        return y
+
+    def step(self, actuators, steady=None, rows=None):
+        # rows advances only those scenarios (e.g. the ones just reset); actuators/steady still cover all N
+        u = np.broadcast_to(np.asarray(actuators, dtype=float), (self.n_scenarios, len(input_params)))
+        steady = self.state.first if steady is None else np.broadcast_to(steady, self.n_scenarios)
+        rows = np.arange(self.n_scenarios) if rows is None else np.flatnonzero(np.isin(np.arange(self.n_scenarios), rows))
+        u, steady = u[rows], steady[rows]
+        y = self.state.y
+
+        # Predict output_params0 (betan, q95, q0, li), steady rows from kstar_nn and the rest from the LSTM
+        i0 = [output_params2.index(p) for p in output_params0]
+        for mask, predict, stage in [(steady, self.predict_steady, 'steady'), (~steady, self.predict_lstm, 'lstm')]:
+            idx = np.flatnonzero(mask)
+            if len(idx) == 0:
+                continue
+            with profiler.stage(stage):
+                y[..., rows[idx, None], i0] = predict(u[idx], slice(None) if len(idx) == self.n_scenarios else rows[idx])
+
+        # Predict output_params1 (betap, wmhd)
+        i1 = [output_params2.index(p) for p in output_params1]
+        with profiler.stage('bpw'):
+            y1 = self.bpw_nn.predict_ensemble(bpw_features(u, y[..., rows, 0]), per_member=self.members)
+            y[..., rows[:, None], i1] = y1 if self.members else np.mean(y1, axis=0)
+
+        # Estimate H factors (h89, h98)
+        with profiler.stage('h_factors'):
+            y[..., rows, 2], y[..., rows, 3] = h_factors(u, y[..., rows, 7])
+
+        self.state.first[rows] = False
+        return np.mean(y[..., rows, :], axis=0) if self.members else y[rows]
+
+    def bands(self, percentiles=(5, 95)):
+        # Mean, std and percentile band over the members of the latest step, each (N, 8)
+        return ensemble_bands(self.state.y, 0, percentiles)
+
+    def predict_boundary_members(self, actuators, scenario=0):
+        # Per-member k2rz boundaries (M, ntheta + 1) of one scenario, using its ensemble-mean betap
+        u = np.broadcast_to(np.asarray(actuators, dtype=float), (self.n_scenarios, len(input_params)))[scenario]
+        betap = np.mean(self.state.y[..., scenario, 1])
+        self.k2rz.set_inputs(u[0], u[1], betap, u[10], u[11], u[12], u[13], u[14])
+        return self.k2rz.predict_members(post=True)
+
+    def predict_boundaries(self, actuators):
+        # Ensemble-mean k2rz boundaries of all scenarios (N, ntheta + 1) from one batched evaluation
+        u = np.broadcast_to(np.asarray(actuators, dtype=float), (self.n_scenarios, len(input_params)))
+        betap = np.mean(self.state.y[..., 1], axis=0) if self.members else self.state.y[:, 1]
+        with profiler.stage('boundary'):
+            return self.k2rz.predict_batch(np.column_stack([u[:, 0], u[:, 1], betap, u[:, 10:15]]))
+
+    def relax(self, actuators, steps):
+        for i in range(steps):
+            y = self.step(actuators)
+        return y
+
+    def rollout(self, waveforms, members=False):
+        # waveforms are (T, N, 15) or (T, 15) shared by all scenarios, returns (T, N, 8),
+        # or (T, M, N, 8) with members=True in the members mode
+        shape = self.state.y.shape if members else (self.n_scenarios, len(output_params2))
+        ys = np.zeros((len(waveforms),) + shape)
+        for i, u in enumerate(waveforms):
+            y = self.step(u)
+            ys[i] = self.state.y if members else y
+        return ys
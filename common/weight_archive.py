@@ -0,0 +1,90 @@
+import os, io, json, struct, zipfile, argparse
+import numpy as np
+from common.numpy_models import load_custom_weights, load_dense_weights, reduce_precision, fold_dense_inputs
+from common.simulator import base_path, nn_model_path, lstm_model_path, bpw_model_path, k2rz_model_path
+
+# One uncompressed .npz holding every model family as stacked (members, ...) arrays.
+# Array data is aligned inside the zip so weight_archive can memory-map it directly,
+# which lets several simulator processes share the same physical pages.
+
+archive_version = 2 # 2: int8 kernels carry per-row scales, reduced Dense kernels keep their input BatchNormalization
+archive_path = base_path + f'/weights/kstar_weights_v{archive_version}.npz'
+alignment = 64
+
+families = {
+    'nn': {'kind': 'dense', 'path': nn_model_path, 'n_models': 10},
+    'lstm': {'kind': 'custom', 'path': lstm_model_path, 'n_models': 10, 'lstms': [100, 100], 'denses': [50, 4]},
+    'bpw': {'kind': 'dense', 'path': bpw_model_path, 'n_models': 10},
+    'bpw_v0': {'kind': 'dense', 'path': base_path + '/weights/bpw/', 'n_models': 10},
+    'k2rz': {'kind': 'dense', 'path': k2rz_model_path, 'n_models': 10},
+}
+
+def family_arrays(family, precision='float32'):
+    if family['kind'] == 'custom':
+        params = load_custom_weights(family['path'], family['n_models'], family['lstms'], family['denses'])
+        return dict(reduce_precision(params, precision), lstms=np.array(family['lstms']), denses=np.array(family['denses']))
+    params, activation_list = load_dense_weights(family['path'], family['n_models'])
+    return dict(fold_dense_inputs(reduce_precision(params, precision)), activations=np.array(activation_list))
+
+def write_aligned(zf, f, name, array):
+    # Pad the local header's extra field so the array data starts on an aligned offset
+    buffer = io.BytesIO()
+    np.lib.format.write_array(buffer, np.ascontiguousarray(array), allow_pickle=False)
+    data = buffer.getvalue()
+    header_length = 10 + struct.unpack('<H', data[8:10])[0] if data[6] == 1 else 12 + struct.unpack('<I', data[8:12])[0]
+    start = f.tell() + 30 + len(name) + 4 + header_length
+    padding = -start % alignment
+    info = zipfile.ZipInfo(name, date_time=(1980, 1, 1, 0, 0, 0))
+    info.extra = struct.pack('<HH', 0xD935, padding) + b'\0' * padding
+    zf.writestr(info, data, compress_type=zipfile.ZIP_STORED)
+
+def build_archive(output_path=archive_path, names=None, precision='float32'):
+    # precision='float16'/'int8' stores reduced kernels, the NumPy engines expand them on use
+    names = list(families.keys()) if names is None else names
+    manifest = {'version': archive_version, 'precision': precision, 'families': {}}
+    with open(output_path, 'wb') as f, zipfile.ZipFile(f, 'w', zipfile.ZIP_STORED) as zf:
+        for name in names:
+            arrays = family_arrays(families[name], precision)
+            manifest['families'][name] = {'source': os.path.relpath(families[name]['path'], base_path), 'n_models': families[name]['n_models']}
+            for key, array in arrays.items():
+                write_aligned(zf, f, f'{name}/{key}.npy', array)
+        write_aligned(zf, f, 'manifest.npy', np.array(json.dumps(manifest)))
+    return output_path
+
+class weight_archive():
+    def __init__(self, path=archive_path, mmap=True):
+        self.path, self.arrays = path, {}
+        self.buffer = np.memmap(path, dtype=np.uint8, mode='r') if mmap else None
+        with open(path, 'rb') as f, zipfile.ZipFile(f) as zf:
+            for info in zf.infolist():
+                key = info.filename[:-len('.npy')]
+                f.seek(info.header_offset)
+                name_length, extra_length = struct.unpack('<HH', f.read(30)[26:30])
+                f.seek(info.header_offset + 30 + name_length + extra_length)
+                version = np.lib.format.read_magic(f)
+                read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else np.lib.format.read_array_header_2_0
+                shape, fortran_order, dtype = read_header(f)
+                if mmap and len(shape) > 0 and dtype.kind in 'fiu':
+                    self.arrays[key] = np.ndarray(shape, dtype=dtype, buffer=self.buffer, offset=f.tell(), order='F' if fortran_order else 'C')
+                else:
+                    self.arrays[key] = np.lib.format.read_array(zf.open(info))
+        self.manifest = json.loads(self.arrays.pop('manifest').item())
+        if self.manifest['version'] != archive_version:
+            raise ValueError(f"Weight archive {path} is version {self.manifest['version']}, expected {archive_version}; rebuild it")
+
+    def __getitem__(self, name):
+        # Family view usable as model_path by the NumPy wrappers
+        if name not in self.manifest['families']:
+            raise KeyError(f'{name} is not in {self.path}')
+        return {key[len(name) + 1:]: value for key, value in self.arrays.items() if key.startswith(name + '/')}
+
+    def names(self):
+        return list(self.manifest['families'].keys())
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pack the KSTAR-NN weights into one memory-mappable archive')
+    parser.add_argument('--output', default=archive_path)
+    parser.add_argument('--families', nargs='+', default=None, choices=list(families.keys()))
+    parser.add_argument('--precision', default='float32', choices=['float32', 'float16', 'int8'])
+    args = parser.parse_args()
+    print(f'Weight archive written to {build_archive(args.output, args.families, args.precision)}')
@@ -4,7 +4,6 @@ import os, sys, time
 import numpy as np
 import matplotlib
 import matplotlib.pyplot as plt
-from matplotlib.path import Path
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
 from PyQt5.QtCore import pyqtSignal,Qt
 from PyQt5.QtWidgets import QApplication,\
@@ -33,7 +32,7 @@ from PyQt5.QtWidgets import QApplication,\
                             QSpinBox,\
                             QDoubleSpinBox
 from keras import models,layers
-from scipy import interpolate
+from common.heat_load import heat_load_legs, heat_load_fits
 
 # Setting
 base_path = os.path.abspath(os.path.dirname(sys.argv[0]))
@@ -367,42 +366,22 @@ class KSTARWidget(QDialog):
         plt.scatter([self.rx1,self.rx2],[self.zx1,self.zx2],marker='x',color='w',s=100*(100/dpi)**2,linewidths=2*(100/dpi),label='X-points')
 
     def plotHeatLoads(self,n=10,both_side=True):
-        kinds = ['linear','quadratic'] #,'cubic']
-        wallPath = Path(np.array([Rwalls,Zwalls]).T)
-        idx1 = list(self.zbdry).index(self.zx1)
-        for kind in kinds:
-            f = interpolate.interp1d(self.rbdry[idx1-5:idx1],self.zbdry[idx1-5:idx1],kind=kind,fill_value='extrapolate')
-            rsol1 = np.linspace(self.rbdry[idx1],np.min(Rwalls)+1.e-4,n)
-            zsol1 = np.array([f(r) for r in rsol1])
-            is_inside1 = wallPath.contains_points(np.array([rsol1,zsol1]).T)
-            
-            f = interpolate.interp1d(self.zbdry[idx1+5:idx1:-1],self.rbdry[idx1+5:idx1:-1],kind=kind,fill_value='extrapolate')
-            zsol2 = np.linspace(self.zbdry[idx1],np.min(Zwalls)+1.e-4,n)
-            rsol2 = np.array([f(z) for z in zsol2])
-            is_inside2 = wallPath.contains_points(np.array([rsol2,zsol2]).T)
-            if not np.all(zsol1[is_inside1]>self.zbdry[idx1+1]):
-                plt.plot(rsol1[is_inside1],zsol1[is_inside1],'r',linewidth=1.5*(100/dpi))
-            plt.plot(rsol2[is_inside2],zsol2[is_inside2],'r',linewidth=1.5*(100/dpi))
-            if both_side:
-                plt.plot(self.rbdry[idx1-4:idx1+4],-self.zbdry[idx1-4:idx1+4],'b',linewidth=2*(100/dpi),alpha=0.1)
-                plt.plot(rsol1[is_inside1],-zsol1[is_inside1],'r',linewidth=1.5*(100/dpi),alpha=0.2)
-                plt.plot(rsol2[is_inside2],-zsol2[is_inside2],'r',linewidth=1.5*(100/dpi),alpha=0.2)
-        for kind in kinds:
-            f = interpolate.interp1d(self.rbdry[idx1-5:idx1+1],self.zbdry[idx1-5:idx1+1],kind=kind,fill_value='extrapolate')
-            rsol1 = np.linspace(self.rbdry[idx1],np.min(Rwalls)+1.e-4,n)
-            zsol1 = np.array([f(r) for r in rsol1])
-            is_inside1 = wallPath.contains_points(np.array([rsol1,zsol1]).T)
-
-            f = interpolate.interp1d(self.zbdry[idx1+5:idx1-1:-1],self.rbdry[idx1+5:idx1-1:-1],kind=kind,fill_value='extrapolate')
-            zsol2 = np.linspace(self.zbdry[idx1],np.min(Zwalls)+1.e-4,n)
-            rsol2 = np.array([f(z) for z in zsol2])
-            is_inside2 = wallPath.contains_points(np.array([rsol2,zsol2]).T)
-            if not np.all(zsol1[is_inside1]>self.zbdry[idx1+1]):
-                plt.plot(rsol1[is_inside1],zsol1[is_inside1],'r',linewidth=1.5*(100/dpi))
-            plt.plot(rsol2[is_inside2],zsol2[is_inside2],'r',linewidth=1.5*(100/dpi))
+        legs = heat_load_legs(self.rbdry,self.zbdry,n)
+        idx1 = legs['index']
+        for i in range(len(heat_load_fits)):
+            rsols,zsols = [],[]
+            for leg in range(2):
+                inside = legs['inside'][i,leg]
+                rsols.append(legs['r'][i,leg][inside])
+                zsols.append(legs['z'][i,leg][inside])
+                if legs['visible'][i,leg]:
+                    plt.plot(rsols[leg],zsols[leg],'r',linewidth=1.5*(100/dpi))
             if both_side:
-                plt.plot(rsol1[is_inside1],-zsol1[is_inside1],'r',linewidth=1.5*(100/dpi),alpha=0.2)
-                plt.plot(rsol2[is_inside2],-zsol2[is_inside2],'r',linewidth=1.5*(100/dpi),alpha=0.2)
+                # The mirrored legs are always drawn, as before
+                if not heat_load_fits[i][1]:
+                    plt.plot(self.rbdry[idx1-4:idx1+4],-self.zbdry[idx1-4:idx1+4],'b',linewidth=2*(100/dpi),alpha=0.1)
+                for rsol,zsol in zip(rsols,zsols):
+                    plt.plot(rsol,-zsol,'r',linewidth=1.5*(100/dpi),alpha=0.2)
         plt.plot([self.rx1],[self.zx1],'r',linewidth=1*(100/dpi),label='Heat load')
 
     def plotBackground(self):